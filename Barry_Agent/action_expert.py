@@ -1,30 +1,38 @@
-import os
+import sys
 import logging
-from dotenv import load_dotenv
+from string import Template
 from PIL import Image
-import google.generativeai as genai
+from .utils import configure_gemini, get_model, encode_image, deprecate_observations, with_retry
 
 logger = logging.getLogger("action_expert")
 
+# Every instruction adds five (user, model) turns to the chat
+MESSAGES_PER_INSTRUCTION = 10
+
+# The raw screenshot is sent downscaled to this long edge as JPEG, the coordinates come from the SOM description
+SCREENSHOT_MAX_EDGE = 1024
+SCREENSHOT_JPEG_QUALITY = 85
+
 # PROMPTS
-FIRST_PROMPT="""
+# The prompts with fields are compiled once as string.Template and filled with `substitute`
+FIRST_PROMPT_TEMPLATE=Template("""
 Instruction:
-{instruction}
+$instruction
 
 Feedback:
 Consider any previous execution errors and solutions provided in this section to avoid repeating mistakes:
-{Reflection_feedback}
+$Reflection_feedback
 
 Task:
 Given the attached screenshot, describe the necessary actions to accomplish the instruction.
 
 Response:
 Provide a clear, concise, and detailed description of the actions to be performed.
-"""
+""")
 
-SECOND_PROMPT="""
+SECOND_PROMPT_TEMPLATE=Template("""
 SOM Element Description:
-{SOM_description}
+$SOM_description
 
 Task:
 From the SOM description, identify boxes relevant to accomplishing the instruction and the actions from the previous query.
@@ -33,7 +41,7 @@ Note: Box numbers are random and not necessarily related. Element names in the S
 Response:
 List the relevant boxes, including their visible numbers. For each box, describe why it is important to solve the instruction. 
 Do not discard relevant boxes even if their number is not visible in the image.
-"""
+""")
 
 THIRD_PROMPT="""
 Task:
@@ -45,9 +53,9 @@ Response:
 The box of the SOM image which I need to use, with the justification of why did you chose this box among the other candidates.
 """
 
-FOURTH_PROMPT="""
+FOURTH_PROMPT_TEMPLATE=Template("""
 Screen resolution:
-{Screen_resolution}
+$Screen_resolution
 
 Task:
 Calculate the center coordinates (x, y) of the box chosen in the previous instruction.
@@ -55,7 +63,7 @@ Note: SOM description coordinates are (upper_left_x, upper_left_y, bottom_right_
 
 Response:
 Provide the center coordinates (x, y) of the chosen box in pixel format, considering the screen resolution and the SOM vertex coordinates.
-"""
+""")
 
 FIFTH_PROMPT="""
 Task:
@@ -80,25 +88,38 @@ Do not include comments or imports, **only** pyautogui instructions. If multiple
 """
 
 class ActionExpert:
-    def __init__(self, model_id: str = "gemini-2.5-flash"):
+    def __init__(self, model_id: str = "gemini-2.5-flash", max_history_instructions: int = 2):
         """
         Action Expert in screen element recognition and PyAutoGUI code generation.
         It uses a Chain-of-Thought prompt mechanism to analyze the task, understand the SOM element description, 
         and finally generate the next action in PyAutoGUI code.
+
+        Args:
+            model_id (str): Gemini model used to generate the actions.
+            max_history_instructions (int): Number of previous instructions whose turns are kept in the chat history.
         """
-        load_dotenv()
-        gemini_api_key = os.getenv("GEMINI_API_KEY")
-        if not gemini_api_key:
+        try:
+            configure_gemini()
+        except ValueError:
             logger.error("GEMINI_API_KEY not found in the .env file for ActionExpert")
-            raise ValueError("GEMINI_API_KEY not found in the .env file")
-        
-        genai.configure(api_key=gemini_api_key)
+            raise
 
-        self.model = genai.GenerativeModel(model_id)
+        self.model = get_model(model_id)
         self.chat = self.model.start_chat(history=[])
+        self.max_history_messages = max_history_instructions * MESSAGES_PER_INSTRUCTION
 
         self.current_instruction = ""
     
+    # LOCAL FUNCTIONS
+
+    @with_retry()
+    def _send_message(self, content):
+        """
+        Sends a message to the action chat, retrying with exponential backoff on transient API errors.
+        A failed message is not added to the chat history, so it can be sent again as is.
+        """
+        return self.chat.send_message(content)
+
     # GLOBAL FUNCTIONS 
     
     def set_current_instruction(self, new_instruction):
@@ -116,7 +137,8 @@ class ActionExpert:
 
         Args:
             new_screenshot(PIL Image): Vanilla image containing the current state of the OSWorld environment. 
-            new_som_screenshot(PIL Image): SOM picture of the current state of the OSWorld environment.
+            new_som_screenshot(dict or PIL Image): SOM picture of the current state of the OSWorld environment,
+                                                   as an inline image part ({"mime_type", "data"}) or a PIL image.
             new_som_description(str): Description of the elements shown in the SOM screenshot.
             reflection_feedback(str): If the action expert has tried to solve the instruction and has failed by a minor error,
                                       it contains the description of the error and a solution. "" otherwise.
@@ -125,17 +147,40 @@ class ActionExpert:
             action(str): pyautogui code that needs to be executed within osworld environment.
         """
         try:
+            # Feedback strings repeat verbatim across turns, share a single copy of them
+            if len(reflection_feedback) < 8192:
+                reflection_feedback = sys.intern(reflection_feedback)
+
             logger.info("Process Instruction inside the Action Expert")
-            first_prompt = FIRST_PROMPT.format(instruction=self.current_instruction, Reflection_feedback=reflection_feedback)
+
+            # Every instruction adds two screenshots to the history, only the last instructions are sent again
+            # and their screenshots are replaced by a placeholder, the new screenshot supersedes them
+            history = self.chat.history
+            if len(history) > self.max_history_messages:
+                start = len(history) - self.max_history_messages
+                # A failed message leaves the history out of step with MESSAGES_PER_INSTRUCTION,
+                # the kept history must still start with a user turn and never with its answer
+                while start < len(history) and history[start].role != "user":
+                    start += 1
+                history = history[start:]
+            self.chat.history = deprecate_observations(history)
+
+            first_prompt = FIRST_PROMPT_TEMPLATE.substitute(instruction=self.current_instruction, Reflection_feedback=reflection_feedback)
             logger.info("CURRENT INSTRUCTION INSIDE THE ACTION: " + self.current_instruction)
-            action = self.chat.send_message([new_screenshot, first_prompt])
-            second_prompt = SECOND_PROMPT.format(SOM_description=new_som_description)
-            action = self.chat.send_message([new_som_screenshot, second_prompt])
-            action = self.chat.send_message(THIRD_PROMPT)
+            # Sent as JPEG bytes instead of the PIL image, which the SDK would encode as full size lossless WebP
+            screenshot_part = {
+                "mime_type": "image/jpeg",
+                "data": encode_image(new_screenshot, max_edge=SCREENSHOT_MAX_EDGE, quality=SCREENSHOT_JPEG_QUALITY,
+                                     resample=Image.LANCZOS, optimize=True),
+            }
+            action = self._send_message([screenshot_part, first_prompt])
+            second_prompt = SECOND_PROMPT_TEMPLATE.substitute(SOM_description=new_som_description)
+            action = self._send_message([new_som_screenshot, second_prompt])
+            action = self._send_message(THIRD_PROMPT)
             screen_resolution = new_screenshot.size
-            fourth_prompt = FOURTH_PROMPT.format(Screen_resolution=screen_resolution)
-            action = self.chat.send_message(fourth_prompt)
-            action = self.chat.send_message(FIFTH_PROMPT)
+            fourth_prompt = FOURTH_PROMPT_TEMPLATE.substitute(Screen_resolution=screen_resolution)
+            action = self._send_message(fourth_prompt)
+            action = self._send_message(FIFTH_PROMPT)
             return action.text
 
         except Exception as e:
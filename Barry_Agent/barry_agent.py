@@ -1,18 +1,13 @@
-import os
+import re
 import logging
-from typing import Dict, List, Tuple, NamedTuple
-from dotenv import load_dotenv
-import google.generativeai as genai
-from PIL import Image
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait
 from .action_expert import ActionExpert
 from .planning_expert import PlanningExpert
 from .reflection_expert import ReflectionExpert
 from .perception_expert import PerceptionExpert
+from .utils import configure_gemini, get_model
 
-from typing import Annotated, Literal
 from langgraph.graph import StateGraph, START, END
-from pydantic import BaseModel, Field
 from typing_extensions import TypedDict
 
 logging.basicConfig(
@@ -27,21 +22,23 @@ logging.basicConfig(
 # Now, get the logger for this module
 logger = logging.getLogger("desktopenv.agent")
 
+# Non-blank lines of the generated action without markdown code fences. The indentation of a line is kept,
+# it belongs to the code, only the trailing whitespace and stray carriage returns are removed
+_ACTION_LINE_RE = re.compile(r"^(?![ \t]*```)([ \t]*\S.*?)[ \t\r]*$", re.M)
+
 class BarryAgent:
     def __init__(self, model: str = "gemini-2.0-flash", observation_type: str = "screenshot", action_space: str = "pyautogui"):
         """
         Initializes the agent with the configuration to interact with OSWorld and the Gemini API.
         """
-        # Cargar variables de entorno desde .env
-        load_dotenv()
-        gemini_api_key = os.getenv("GEMINI_API_KEY")
-        if not gemini_api_key:
+        # Loads the .env file and configures the Gemini API once per process, shared with the experts
+        try:
+            configure_gemini()
+        except ValueError:
             logger.error("GEMINI_API_KEY not found in the .env file")
-            raise ValueError("GEMINI_API_KEY not found in the .env file")
+            raise
 
-        # Configurar la API de Gemini
-        genai.configure(api_key=gemini_api_key)
-        self.model = genai.GenerativeModel(model)
+        self.model = get_model(model)
 
         # Configurar parámetros del entorno
         self.observation_type = observation_type
@@ -69,6 +66,11 @@ class BarryAgent:
         self.SOM_screenshot = ""
         self.SOM_description = ""
 
+        # Omniparser runs in the background while the reflection and planning experts call the LLM,
+        # only the action expert needs its results
+        self._perception_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="perception")
+        self._perception_future = None
+
         self.sleep = False
 
         # LANG GRAPH
@@ -79,7 +81,7 @@ class BarryAgent:
             reflection_action: str
             reflection_planning: str
 
-            osworld_action: List[str]
+            osworld_action: list[str]
             done: bool
         
 
@@ -105,47 +107,37 @@ class BarryAgent:
                     Then the planning expert returns the current subtask.
 
                 case 2: Action experts finish the instruction_list and reflection_expert says it is correct:
-                    First we ask the planning expert if this was the last task.
+                    We ask the planning expert, in a single call, if this was the last task and otherwise
+                    for the next subtask already decomposed into its instruction list.
                     If it was the last done = true is returned.
-                    If it wasn't the last task it tells the planning expert to rethink the rest of the subtask.
-                    Rethinking the subtask list implies to delete the subtasks already made and generate a list that 
-                    STRATS with the ones that are still needed to be done.
-                    The planning expert returns the inmediate first task of the new subtask list.
 
                 case 3: There is an error. Either execution error during the instruction list or because refelction expert don't think it is finished:
-                    It only calls the function rethink_subtask() but with the reflection_expert_feedback and the action_expert_feedback.
-                    It is the same function as the case 2. The planning expert creates a new subtask list and returns the first subtask.
+                    It is the same single call as the case 2 but with the reflection_expert_feedback, so the planning
+                    expert replans a new subtask with a different approach, already decomposed into its instruction list.
 
                 Common actions:
                 In the past cases the planning expert always returns a subtask. So after every case this task must be decomposed into
-                an instruction list. When we have the current subtask and instruction list we call reflection expert to save the subtask and instruction list.
+                an instruction list (cases 2 and 3 get it already decomposed). When we have the current subtask and instruction list we call 
+                reflection expert to save the subtask and instruction list.
                 
             """
-            logger.info("reflection planing: " + state["reflection_planning"])
+            logger.info("reflection planing: %s", state["reflection_planning"])
 
             # case 1
             if self.first_iteration:
                 self.planning_expert.decompose_main_task(self.main_task, self.screenshot)
                 self.first_iteration = False
+                instruction_list = self.planning_expert.decompose_subtask(self.screenshot)
 
-            # case 2
-            elif state["reflection_planning"] == "finish":
-                done = self.planning_expert.is_main_task_done(self.screenshot)
+            # case 2 and case 3: the completion check, the new subtask and its instructions come from a single call
+            else:
+                feedback = "" if state["reflection_planning"] == "finish" else state["reflection_planning"]
+                done, instruction_list = self.planning_expert.plan_step(feedback, self.screenshot)
                 logger.info("is main task done?:")
                 logger.info(done)
 
                 if done:
                     return {"done": True}
-                else:
-                   self.planning_expert.rethink_subtask("", self.screenshot)
-                   
-            # case 3
-            else:
-                self.planning_expert.rethink_subtask(state["reflection_planning"], self.screenshot)
-
-            # This has to be done after every case:
-            instruction_list = self.planning_expert.decompose_subtask(self.screenshot)
-            #loggerf"These are the instructions for the task: {instruction_list}")
 
 
 
@@ -175,6 +167,7 @@ class BarryAgent:
 
             # Process the current instruction from the instruction list
             feedback = state["reflection_action"]
+            self._wait_for_perception()
             action = self.action_expert.process_instruction(self.screenshot, self.SOM_screenshot, self.SOM_description, feedback)
             
             return {
@@ -202,7 +195,8 @@ class BarryAgent:
                     - It was a minor error: {reflection_action: error and how to solve it}
                     - It was a major error: {reflection_planning: error and how to solve it}
             """
-            successful = self.reflection_expert.evaluate_execution(self.screenshot)
+            # The error is evaluated concurrently, it is only used if the execution failed
+            successful, evaluated_error = self.reflection_expert.evaluate_execution_and_error(self.screenshot)
 
             # case 1
             if successful:
@@ -221,19 +215,20 @@ class BarryAgent:
                     }
             
             # case 2
-            evaluated_error = self.reflection_expert.evaluate_error(self.screenshot)
-            if evaluated_error.startswith("Minor:"):
+            severity, solution = evaluated_error
+            feedback = f"{severity.capitalize()}: {solution}"
+            if severity == "minor":
                 new_instruction = self.reflection_expert.create_new_instruction()
                 self.action_expert.set_current_instruction(new_instruction)
 
                 return {
-                    "reflection_action": evaluated_error,
+                    "reflection_action": feedback,
                     "reflection_planning": ""
                 }
             else:
                 return {
                     "reflection_action": "",
-                    "reflection_planning": evaluated_error
+                    "reflection_planning": feedback
                 }
 
         
@@ -268,8 +263,8 @@ class BarryAgent:
     def _process_new_screenshot(self, obs:dict):
         """
         Processes the new screenshot of the OSWorld environment through the Perception System.
-        Generates the SOM of the screenshot and a description of its components.
-        Stores the results in the self.screenshot, self.SOM_screenshot andself.SOM_description local variables.
+        Stores the screenshot in self.screenshot and starts generating, in a background thread, the SOM of
+        the screenshot and a description of its components. `_wait_for_perception` provides the results.
         """
         if self.observation_type not in ["screenshot"]:
             raise ValueError(f"observation_type not supported: {self.observation_type}")
@@ -277,16 +272,33 @@ class BarryAgent:
         if "screenshot" not in obs:
             raise ValueError("'screenshot' was not found in the recieved observation")
         
+        # The processing of the previous screenshot may still be running and reads the stored screenshot
+        if self._perception_future is not None:
+            wait([self._perception_future])
+
         self.perception_expert.store_screenshot(obs["screenshot"])
-        self.perception_expert.process_screenshot()
+        self.screenshot = self.perception_expert.get_screenshot()
+        # Decoded here, PIL's lazy load is not thread-safe and the screenshot is read from several threads
+        self.screenshot.load()
+
+        # The reflection expert encodes the screenshot in the background while Omniparser processes it
+        self.reflection_expert.prefetch_screenshot(self.screenshot)
+        self._perception_future = self._perception_executor.submit(self.perception_expert.process_screenshot)
+
+    def _wait_for_perception(self):
+        """
+        Waits for the Perception System to process the last screenshot and stores the results in the
+        self.SOM_screenshot and self.SOM_description local variables.
+        Errors of the processing (e.g. the Omniparser server is unreachable) are raised here.
+        """
+        self._perception_future.result()
 
         # Store the results in the local variables
-        self.screenshot = self.perception_expert.get_screenshot()
         self.SOM_screenshot = self.perception_expert.get_som_screenshot()
         self.SOM_description = self.perception_expert.get_som_description()
     
 
-    def predict(self, instruction: str, obs: Dict) -> Tuple[str, List[str]]:
+    def predict(self, instruction: str, obs: dict) -> tuple[str, list[str]]:
         """
         Sends the screenshot and the instruction to the Agent in order to generate PyAutoGUI actions.
         """
@@ -294,7 +306,7 @@ class BarryAgent:
         self.trajectory_length += 1
 
         if self.trajectory_length > self.max_trajectory_length:
-            logger.warning(f"Trajectory exceeds the maximum limit of {self.max_trajectory_length} steps")
+            logger.warning("Trajectory exceeds the maximum limit of %d steps", self.max_trajectory_length)
             return "Maximum trajectory length exceeded", ["FAIL"]
 
         try:
@@ -331,7 +343,8 @@ class BarryAgent:
 
             if osworld_action_to_return:
                 # logger.info(f"BarryAgent: Action decided by the agent: '{osworld_action_to_return}'")
-                pyautogui_instructions = [line for line in osworld_action_to_return.strip().splitlines() if line]
+                # Each line is executed on its own, a single pass drops blank lines and ``` fences
+                pyautogui_instructions = _ACTION_LINE_RE.findall(osworld_action_to_return)
                 pyautogui_instructions.append("time.sleep(3)")
                 logger.info("instructions to execute")
                 logger.info(pyautogui_instructions)
@@ -343,7 +356,7 @@ class BarryAgent:
                 return "FAIL: No OSWorld action generated in this cycle.", ["FAIL"]
 
         except Exception as e:
-            logger.error(f"Error during prediction: {e}")
+            logger.error("Error during prediction: %s", e)
             return "FAIL: Exception occurred during prediction.", ["FAIL"]
 
 
@@ -1,11 +1,39 @@
 import base64
+import hashlib
 import requests
 import os
+from collections import OrderedDict
 from PIL import Image
 from io import BytesIO
-import io
 from dotenv import load_dotenv
 
+# Number of processed screenshots whose SOM and description are kept
+SOM_CACHE_MAX_ENTRIES = 32
+
+# Leading bytes of the image formats that can be sent to Gemini without decoding them
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"RIFF", "image/webp"),
+)
+
+def _sniff_mime_type(data: bytes):
+    """
+    Identifies the MIME type of an encoded image by its signature.
+
+    Args:
+        data(bytes): The encoded image.
+
+    Returns:
+        mime_type(str): "image/png", "image/jpeg" or "image/webp", None if the format is not recognized.
+    """
+    for signature, mime_type in _IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            if mime_type == "image/webp" and data[8:12] != b"WEBP":
+                continue
+            return mime_type
+    return None
+
 class PerceptionExpert:
     def __init__(self):
         """
@@ -26,6 +54,11 @@ class PerceptionExpert:
         self.som_screenshot = ""
         self.som_description = ""
 
+        # BLAKE2b digest of the stored screenshot, identical screenshots (e.g. while waiting for the
+        # screen to change) are not sent to the Omniparser server again
+        self.screenshot_digest = None
+        self.som_cache = OrderedDict() # screenshot digest -> (SOM screenshot, SOM description)
+
     # LOCAL FUNCTIONS
     def _format_som_description(self, elements):
         """
@@ -59,7 +92,10 @@ class PerceptionExpert:
         """
         # If the screenshot is a byte string (raw screenshot data), process it into base64
         if isinstance(screenshot, bytes):
+            self.screenshot_digest = hashlib.blake2b(screenshot, digest_size=16).digest()
             screenshot = base64.b64encode(screenshot).decode('utf-8')
+        else:
+            self.screenshot_digest = hashlib.blake2b(screenshot.encode('utf-8'), digest_size=16).digest()
         
         self.screenshot = screenshot
 
@@ -71,8 +107,15 @@ class PerceptionExpert:
         makes the computation and returns the results.
 
         Stores the marked screenshot and the description in the self.som_screenshot and 
-        self.som_description respectively.
+        self.som_description respectively. If the same screenshot was already processed,
+        the previous results are reused without contacting the server.
         """
+        cached = self.som_cache.get(self.screenshot_digest)
+        if cached is not None:
+            self.som_cache.move_to_end(self.screenshot_digest)
+            self.som_screenshot, self.som_description = cached
+            return
+
         url = f"{self.omniparser_server}/parse/"
         payload = {"base64_image": self.screenshot} 
         
@@ -81,13 +124,22 @@ class PerceptionExpert:
             response.raise_for_status() # Raise an exception for HTTP Errors
             result = response.json()
             
-            # Convert the base64 string to a Pillow Image
+            # The SOM is only forwarded to Gemini, so a PNG/JPEG/WebP is kept as the raw bytes of an inline
+            # part instead of being decoded to a Pillow Image that the SDK would encode again
             som_image_64 = result["som_image_base64"]
             image_bytes = base64.b64decode(som_image_64)
-            self.som_screenshot = Image.open(BytesIO(image_bytes))
+            mime_type = _sniff_mime_type(image_bytes)
+            if mime_type is not None:
+                self.som_screenshot = {"mime_type": mime_type, "data": image_bytes}
+            else:
+                self.som_screenshot = Image.open(BytesIO(image_bytes))
             
             self.som_description = self._format_som_description(result["parsed_content_list"])
 
+            self.som_cache[self.screenshot_digest] = (self.som_screenshot, self.som_description)
+            while len(self.som_cache) > SOM_CACHE_MAX_ENTRIES:
+                self.som_cache.popitem(last=False)
+
         except requests.exceptions.RequestException as e:
             raise ConnectionError(f"Error connecting to Omniparser server: {e}")
         
@@ -98,7 +150,7 @@ class PerceptionExpert:
         and 'process_screenshot' functions.
 
         Returns:
-            SOM screenshot in base64 format.
+            SOM screenshot as an inline image part ({"mime_type", "data"}), or a Pillow Image if its format is not recognized.
         """
         return self.som_screenshot
 
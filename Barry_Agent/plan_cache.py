@@ -0,0 +1,226 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import Counter
+from .utils import image_digest
+
+
+logger = logging.getLogger("plan_cache")
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60  # 7 days
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024  # 100 MB
+# Hits counted in memory before they are written, so a read does not write to the database every time
+HITS_FLUSH_THRESHOLD = 32
+
+
+def task_fingerprint(*texts, image=None) -> str:
+    """
+    Computes the fingerprint used as key of the response caches.
+
+    Only the whitespace of the texts is collapsed, so that trivial formatting differences of the same
+    task map to the same entry. The case is kept: it can be meaningful (e.g. a file name or a text to type).
+
+    Args:
+        *texts (str): Text fields identifying the request (e.g. the method name and the task).
+        image (PIL Image): Optional screenshot of the GUI state the request refers to.
+
+    Returns:
+        str: Hexadecimal SHA-256 fingerprint.
+    """
+    fingerprint = hashlib.sha256()
+    for text in texts:
+        fingerprint.update(" ".join(text.split()).encode("utf-8"))
+        fingerprint.update(b"\x00")
+    if image is not None:
+        fingerprint.update(image_digest(image))
+    return fingerprint.hexdigest()
+
+
+# Task specific values: quoted text, URLs and file names. A file name needs a base of at least two
+# characters and an extension starting with a letter, so abbreviations ("e.g") and numbers ("3.5") are kept
+_ENTITY_RE = re.compile(r'"([^"]+)"|\'([^\']+)\'|(https?://\S+)|\b([\w-]{2,}\.[A-Za-z][A-Za-z0-9]{0,4})\b')
+_MIN_ENTITY_LENGTH = 3  # shorter values would be replaced by accident inside other words
+
+
+def task_skeleton(task: str):
+    """
+    Computes the pattern of a task by replacing its specific values with placeholders, so that
+    tasks like 'download "dog.png"' and 'download "cat.png"' share the same skeleton.
+
+    Args:
+        task (str): The main task.
+
+    Returns:
+        tuple[str, list[str]]: The skeleton of the task and the values that were replaced, in order.
+    """
+    entities = []
+
+    def replace(match):
+        entities.append(next(group for group in match.groups() if group))
+        return "<X>"
+
+    skeleton = _ENTITY_RE.sub(replace, task)
+    return skeleton, entities
+
+
+def parameterize(text: str, entities: list):
+    """
+    Replaces the task specific values in a response with numbered slots (<SLOT0>, <SLOT1>, ...).
+
+    Longer values are replaced first, so a value that contains another one is not split. A template
+    must not keep any value of the task it was built from, because it is replayed for other values:
+    if a value is too short to be replaced safely or does not appear in the response, there is no template.
+
+    Args:
+        text (str): The response of the LLM.
+        entities (list[str]): The task specific values, in the order of their slots.
+
+    Returns:
+        str: The parameterized response, or None if it cannot be parameterized safely.
+    """
+    for index in sorted(range(len(entities)), key=lambda index: len(entities[index]), reverse=True):
+        entity = entities[index]
+        if len(entity) < _MIN_ENTITY_LENGTH or entity not in text:
+            return None
+        text = text.replace(entity, f"<SLOT{index}>")
+    return text
+
+
+def fill_slots(template: str, entities: list) -> str:
+    """
+    Fills the numbered slots of a parameterized response with the values of the current task.
+    """
+    for index, entity in enumerate(entities):
+        template = template.replace(f"<SLOT{index}>", entity)
+    return template
+
+
+class ResponseCache:
+    def __init__(self, path: str = None, table: str = "plans", ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Persistent cache of LLM responses keyed by a fingerprint, used for the planning responses
+        and the reflection verdicts.
+
+        Entries are stored in a SQLite database so every write is atomic. Entries older than
+        `ttl_seconds` are discarded on read and, when the stored responses exceed `max_bytes`,
+        the least frequently used entries are evicted first. The hits used by the eviction are
+        counted in memory and written in batches, a few of them may be lost when the process exits.
+
+        Args:
+            path (str): Path of the SQLite database. Defaults to 'cache/plan_cache.sqlite'
+                        inside the Barry Agent directory.
+            table (str): Table holding the entries, each kind of response has its own.
+            ttl_seconds (int): Time to live of every entry.
+            max_bytes (int): Maximum size of the stored responses.
+        """
+        if not table.isidentifier():
+            raise ValueError(f"Invalid cache table name: {table}")
+
+        if path is None:
+            cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
+            os.makedirs(cache_dir, exist_ok=True)  # Create cache directory if it doesn't exist
+            path = os.path.join(cache_dir, 'plan_cache.sqlite')
+
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._pending_hits = Counter()  # fingerprint -> hits not written yet
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "fingerprint TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "hits INTEGER NOT NULL DEFAULT 0, "
+                "created REAL NOT NULL)"
+            )
+
+    def get(self, fingerprint: str):
+        """
+        Looks up a cached response.
+
+        Args:
+            fingerprint (str): Key computed with `task_fingerprint`.
+
+        Returns:
+            str: The cached response, or None if there is no valid entry or the database cannot be read
+                 (e.g. it is locked by another process).
+        """
+        try:
+            with self._lock, self._connection:
+                row = self._connection.execute(
+                    f"SELECT value, created FROM {self.table} WHERE fingerprint = ?", (fingerprint,)
+                ).fetchone()
+                if row is None:
+                    return None
+
+                value, created = row
+                if time.time() - created > self.ttl_seconds:
+                    self._connection.execute(f"DELETE FROM {self.table} WHERE fingerprint = ?", (fingerprint,))
+                    return None
+
+                self._pending_hits[fingerprint] += 1
+                if sum(self._pending_hits.values()) >= HITS_FLUSH_THRESHOLD:
+                    self._flush_hits()
+                return value
+        except sqlite3.Error as e:
+            # The cache is an optimization, never break the agent because of it
+            logger.warning(f"Could not read entry from the {self.table} cache: {e}")
+            return None
+
+    def put(self, fingerprint: str, value: str) -> None:
+        """
+        Stores a response in the cache, evicting the least frequently used entries if needed.
+
+        Args:
+            fingerprint (str): Key computed with `task_fingerprint`.
+            value (str): Response to store.
+        """
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (fingerprint, value, size, hits, created) VALUES (?, ?, ?, 0, ?)",
+                    (fingerprint, value, len(value.encode("utf-8")), time.time()),
+                )
+                self._pending_hits.pop(fingerprint, None)  # hits of the replaced entry
+                self._flush_hits()
+                self._evict()
+        except sqlite3.Error as e:
+            # The cache is an optimization, never break the agent because of it
+            logger.warning(f"Could not store entry in the {self.table} cache: {e}")
+
+    def _flush_hits(self) -> None:
+        """
+        Writes the hits counted in memory since the last flush.
+        """
+        if self._pending_hits:
+            self._connection.executemany(
+                f"UPDATE {self.table} SET hits = hits + ? WHERE fingerprint = ?",
+                [(hits, fingerprint) for fingerprint, hits in self._pending_hits.items()],
+            )
+            self._pending_hits.clear()
+
+    def _evict(self) -> None:
+        """
+        Removes expired entries and then the least frequently used ones until the cache fits in `max_bytes`.
+        """
+        self._connection.execute(f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl_seconds,))
+
+        total = self._connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self._connection.execute(f"SELECT fingerprint, size FROM {self.table} ORDER BY hits ASC, created ASC").fetchall()
+        for fingerprint, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._connection.execute(f"DELETE FROM {self.table} WHERE fingerprint = ?", (fingerprint,))
+            total -= size
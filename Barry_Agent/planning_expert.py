@@ -1,74 +1,95 @@
 import os
+import re
+import sys
+import json
 import logging
-from dotenv import load_dotenv
+import threading
+from string import Template
 import google.generativeai as genai
-from PIL import Image
-from .utils import parse_llm_response
+from .utils import parse_llm_json, message_text, deprecate_observations, append_chat_turn, with_retry, configure_gemini, get_model, encode_image
+from .plan_cache import ResponseCache, task_fingerprint, task_skeleton, parameterize, fill_slots
 from datetime import datetime
 
 
 logger = logging.getLogger("planning_expert")
 
-DECOMPOSE_MAIN_TASK_PROMPT_TEMPLATE = """
-This is the main task: "{main_task}"
-Give me the first subtask to acoplish the main task The subtask must be goals and they should be used for guidance. 
-Avoid subtasks that involve taking screenshots, locating elements, or recording coordinates, as the agent has screen markers for execution. 
-Identify the active application or window in the screenshot to ensure subtasks align with the current context (e.g., browser, file explorer). 
-Do not include a final subtask like 'Finish the task'; each subtask must be meaningful.
-
-Here's how I want you to structure your response:
-1.  **Reasoning Process:** Write down your thought process here.
-2.  **Final Subtasks:** The subtask MUST start with the exact phrase "RESPONSE:" on its own line, followed immediately by the subtask.
-"""
+# Screenshots are sent inline downscaled to this long edge as JPEG, enough to plan on
+SCREENSHOT_MAX_EDGE = 768
+
+# Static rules shared by every planning prompt. They are sent once as the system instruction of the model,
+# so each turn only carries its variable part and the static tokens stay byte-identical across calls.
+PLANNING_SYSTEM_INSTRUCTION = """
+You are the Planning Expert of an agent that operates a computer GUI with pyAutoGUI. Every request comes with a screenshot of the current GUI state.
 
-RETHINK_SUBTASK_PROMPT_TEMPLATE = """
-Give me the next subtask to acomplish the main task.
-Do not repeat approaches that failed, as indicated by this feedback (if any): {reflection_expert_feedback}.
-If the current subtask "{current_subtask}" was completed successfully, determine the next subtask.
-Analyze the screenshot to identify the active application, visible elements (e.g., browser tabs, search bars), and current state.
-The subtask must be a goal and it should be used for guidance. It is not a instruction to perform the task. 
-Avoid subtasks that involve taking screenshots, locating elements, or recording coordinates, as the agent has screen markers for execution. 
-Identify the active application or window in the screenshot to ensure subtask aligns with the current context (e.g., browser, file explorer). 
-If there is NOTHING to do because the main task is done make an instruction with an sleep of 1 second.
-
-Reasoning Process:
-1. Review the feedback (if any) to identify what went wrong or what subtask was completed.
-2. Analyze the screenshot to determine the active application, window state, and visible elements.
-3. If feedback indicates failure, devise an alternative approach (e.g., use a different application, a different path to get to the same point).
-4. If the subtask was completed, identify the next goal to complete the main task.
-
-
-Here's how I want you to structure your response:
-1.  **Reasoning Process:**  Write down your thought process here.
-2.  **Final Subtask:** The subtask MUST start with the exact phrase "RESPONSE:" on its own line, followed immediately by the subtask.
+Subtask rules:
+- A subtask is a goal and it should be used for guidance. It is not an instruction to perform the task.
+- Avoid subtasks that involve taking screenshots, locating elements, or recording coordinates, as the agent has screen markers for execution.
+- Identify the active application or window in the screenshot to ensure subtasks align with the current context (e.g., browser, file explorer).
+- Do not include a final subtask like 'Finish the task'; each subtask must be meaningful.
+
+Instruction rules:
+0. There is no need to decompose a sequence of keys in different instructions. In pyAutoGUI you can press different keys at the same time and it does not need different instructions.
+1. Analyze the screenshot to identify the active application, visible elements (e.g., address bar, search bar, buttons), and window state.
+2. Think about how to execute the instruction using combination of hotkeys.
+3. Combine related actions (e.g., click, select text with Ctrl+A, type and press enter) into a SINGLE instruction (NOT SEPARATED WITH ';') where appropriate.
+   If there is text were it should be clicked there is no need to use hotkeys as the llm is good clicking where there is text! in the SAME instruction, not in different instructions
+4. Avoid instructions for screenshots, locating elements, or recording coordinates, as the agent has screen markers.
+5. If an element is ambiguous (e.g., multiple search bars), specify which one (e.g., 'the browser's address bar').
+6. Do not make any instruction of release button as in pyAutoGUI there is not such instruction.
+7. Do not put 'if' in instructions, you are being passed a screenshot. You decide what to do.
+8. Remember that if there is text on a text box you will have to do ctrl + A before typing the new text
+9. If it is need it to click on a place where there is no icon or text describe its position referencing a place where there is text or a icon.
+
+Response format, unless a request specifies another one:
+Answer only with the JSON object defined by the response schema of the request, without any other text.
+Instruction lists are JSON arrays with one instruction per item.
+
+Example of how an instruction list should appear:
+{"instructions": ["Click on the browser icon", "Click on the search bar and Type dogs."]}
 """
 
+# Response schemas of the planning requests, answered in JSON mode so no reasoning text has to be decoded or parsed.
+# Gemini generates the properties in alphabetical order, so "done" is always the first field of the plan step.
+SUBTASK_SCHEMA = {
+    "type": "object",
+    "properties": {"subtask": {"type": "string"}},
+    "required": ["subtask"],
+}
+
+INSTRUCTIONS_SCHEMA = {
+    "type": "object",
+    "properties": {"instructions": {"type": "array", "items": {"type": "string"}}},
+    "required": ["instructions"],
+}
+
+PLAN_STEP_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "done": {"type": "boolean"},
+        "subtask": {"type": "string"},
+        "subtask_instructions": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["done"],
+}
+
+SUBTASK_GENERATION_CONFIG = genai.GenerationConfig(response_mime_type="application/json", response_schema=SUBTASK_SCHEMA)
+INSTRUCTIONS_GENERATION_CONFIG = genai.GenerationConfig(response_mime_type="application/json", response_schema=INSTRUCTIONS_SCHEMA)
+PLAN_STEP_GENERATION_CONFIG = genai.GenerationConfig(response_mime_type="application/json", response_schema=PLAN_STEP_SCHEMA)
+
+_DONE_RE = re.compile(r'"done"\s*:\s*(true|false)')
+
+DECOMPOSE_MAIN_TASK_PROMPT_TEMPLATE = """
+This is the main task: "{main_task}"
+Give me the first subtask to acoplish the main task.
+"""
+# Templates with a single variable are split once around it and filled by concatenation
+DECOMPOSE_MAIN_TASK_PROMPT_PREFIX, DECOMPOSE_MAIN_TASK_PROMPT_SUFFIX = DECOMPOSE_MAIN_TASK_PROMPT_TEMPLATE.split("{main_task}")
 
 DECOMPOSE_SUBTASK_PROMPT_TEMPLATE = """
-Decompose the subtask "{current_subtask}" into detailed, actionable instructions. 
-IMPORTANT THINGS TO TAKE INTO ACCOUNT:
-0. There is no need to decompose a sequence of keys in different instructions. In pyAutoGUI you can press different keys at the same time and it does not need different instructions.
-1. Analyze the screenshot to identify the active application, visible elements (e.g., address bar, search bar, buttons), and window state. 
-3. Think about how to execute the instruction using combination of hotkeys. 
-4. Combine related actions (e.g., click, select text with Ctrl+A, type and press enter) into a SINGLE instruction (NOT SEPARATED WITH ';') where appropriate. 
-   If there is text were it should be clicked there is no need to use hotkeys as the llm is good clicking where there is text! in the SAME instruction, not in different instructions 
-5. Avoid instructions for screenshots, locating elements, or recording coordinates, as the agent has screen markers. 
-6. If an element is ambiguous (e.g., multiple search bars), specify which one (e.g., 'the browser's address bar').
-7. Do not make any instruction of release button as in pyAutoGUI there is not such instruction.
-8. Do not put 'if' in instructions, you are being passed a screenshot. You decide what to do.
-9. Remember that if there is text on a text box you will have to do ctrl + A before typing the new text
-
-
-If it is need it to click on a place where there is no icon or text describe its position referencing a place where there is text or a icon.
-
-Here's how I want you to structure your response:
-1.  **Reasoning Process:** Write down your thought process here and the first version of your answer.
-2.  **Revised Instruction List:** After your reasoning, you MUST provide the revised list of the instruction list. This list MUST start with the exact phrase "RESPONSE:" on its own line, followed immediately by the instructions. 
-All text from "RESPONSE:" until the end of your response will be considered the revised list of instructions. Each instruction should be separated by a semicolon ';'.
-
-Example of how the revised subtask list should appear:
-RESPONSE: Click on the browser icon; Click on the search bar and Type dogs.
+Decompose the subtask "{current_subtask}" into detailed, actionable instructions following the instruction rules.
+For this request answer in plain text, not JSON: write your reasoning and a first version of the instruction list.
 """
+DECOMPOSE_SUBTASK_PROMPT_PREFIX, DECOMPOSE_SUBTASK_PROMPT_SUFFIX = DECOMPOSE_SUBTASK_PROMPT_TEMPLATE.split("{current_subtask}")
 
 DECOMPOSE_SUB_TASK_PROMPT_TEMPLATE_REFLECT = """
 Reflect Questions:
@@ -80,76 +101,200 @@ Reflect Questions:
 7. Do any of the instructions include instructions to "release" a key or mouse button?
 8. Are there any 'if' in the instructions? (it should not be)
 
-Here's how I want you to structure your response:
-1.  **Reflect Process:** Review your answer answering the Reflect questions.
-2.  **Revised Instruction List:** After your reasoning, you MUST provide the revised list of the instruction list. This list MUST start with the exact phrase "RESPONSE:" on its own line, followed immediately by the instructions. 
-All text from "RESPONSE:" until the end of your response will be considered the revised list of instructions. Each instruction should be separated by a semicolon ';'
-
-Example of how the revised subtask list should appear:
-RESPONSE: Click on the browser icon; Click on the search bar and Type dogs.
+Review your answer answering the Reflect questions and give the revised instruction list as the final answer.
 """
 
-IS_LAST_TASK_PROMPT_TEMPLATE = """
-The subtask "{current_subtask}" was completed successfully.
-The main task is: "{main_task}".
-Analize if there is still need to press a save or done button or click outside th text box
-Analyze the screenshot to verify if the main task is complete (e.g., check for a downloaded file, specific UI state, or visible result).
-Respond with 'yes' if the main task is fully accomplished, or 'no' if additional steps are needed.
+# Templates with several variables are precompiled as string.Template
+PLAN_STEP_PROMPT_TEMPLATE = Template("""
+The subtask "$current_subtask" $subtask_outcome.
+The main task is: "$main_task".
+Do not repeat approaches that failed, as indicated by this feedback (if any): $reflection_expert_feedback.
 
-Here's how I want you to structure your response:
-1.  **Reasoning Process:** Write down your thought process here.
-2.  **Final answer:** After your reasoning, you MUST respond with 'RESPONSE:' followed only with a 'yes' or 'no'
+Answer the three following questions at once:
+1. Is the main task fully accomplished? Analize if there is still need to press a save or done button or click outside the text box.
+   Analyze the screenshot to verify it (e.g., check for a downloaded file, specific UI state, or visible result).
+2. If it is not accomplished, which is the next subtask?
+3. Decompose that subtask into detailed, actionable instructions following the instruction rules.
+
+Fill "done" with the answer to question 1. If the main task is not accomplished, fill "subtask" with the next subtask
+and "subtask_instructions" with its instructions, otherwise leave them empty.
+""")
+# Outcome of the previous subtask in the plan step prompt, depending on whether there is reflection feedback
+SUBTASK_COMPLETED = "was completed"
+SUBTASK_FAILED = ("could not be completed. Devise an alternative approach for the next subtask "
+                  "(e.g., use a different application, a different path to get to the same point)")
 
-Example: 
-RESPONSE:yes
-"""
+
+HISTORY_SUMMARY_PROMPT_TEMPLATE = Template("""
+Summarize the following earlier part of the conversation of a GUI agent planner so that it can be dropped from the history.
+Keep the main task, the subtasks already completed, the approaches that failed and why, and the last known state of the GUI.
+Write a short plain text summary, not JSON.
+
+Previous summary (if any): $previous_summary
+
+Conversation:
+$conversation
+""")
 
 
 class PlanningExpert:
-    def __init__(self, model_id: str = "gemini-2.0-flash"):
+    def __init__(self, model_id: str = "gemini-2.0-flash", small_model_id: str = "gemini-2.0-flash-lite",
+                 use_plan_cache: bool = True, max_history_turns: int = 6):
         """
         Initialitation of the Planning Expert
+
+        Args:
+            model_id (str): Gemini model used for planning.
+            small_model_id (str): Cheaper Gemini model used for the one-shot auxiliary calls that do not plan.
+            use_plan_cache (bool): Reuse the decompositions of already seen tasks and screens
+                                   instead of asking the LLM again.
+            max_history_turns (int): Number of recent (user, model) turns kept verbatim in the chat history.
+                                     Older turns are replaced by a summary so each call has a bounded prefill.
         """
-        load_dotenv()
-        gemini_api_key = os.getenv("GEMINI_API_KEY")
-        if not gemini_api_key:
+        try:
+            configure_gemini()
+        except ValueError:
             logger.error("GEMINI_API_KEY not found in the file .env for Planning Expert")
-            raise ValueError("GEMINI_API_KEY not found in the file .env")
-        
-        genai.configure(api_key=gemini_api_key)
-        self.model = genai.GenerativeModel(model_id)
+            raise
+
+        self.model = get_model(model_id, PLANNING_SYSTEM_INSTRUCTION)
+        self.small_model = get_model(small_model_id)
 
         self.chat = self.model.start_chat(history=[])
         self.last_printed_index = 0 # this is for printing the chat history for debugging
 
+        self.max_history_turns = max_history_turns
+        self.history_summary = ""  # summary of the turns dropped from the chat history
+
         self.main_task = ""
         self.current_subtask = ""
 
         self.first_iter = True    
 
+        self.plan_cache = ResponseCache() if use_plan_cache else None
+        # Last screenshot prepared by `_screenshot_part` and its inline part, shared by the calls of a step
+        self._prepared_screenshot = (None, None)
+
         # Set up log file directory and path
         self.log_dir = os.path.join(os.path.dirname(__file__), 'logs')
         os.makedirs(self.log_dir, exist_ok=True)  # Create logs directory if it doesn't exist
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.log_file = os.path.join(self.log_dir, f'chat_history_{timestamp}.log')
+        # Agents of different environments are created in their own threads, often in the same second
+        self.log_file = os.path.join(self.log_dir, f'chat_history_{timestamp}_{threading.current_thread().name}.log')
     
     def _save_chat_history_to_file(self):
         """
         Saves the chat history to a log file since the last printed index.
         Each message includes a timestamp, role, and content.
+        The new messages are buffered and written with a single call.
         """
         try:
+            history = self.chat.history
+            if self.last_printed_index >= len(history):
+                return
+
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            log_entries = "".join(
+                f"[{timestamp}] {message.role} PLANNING EXPERT: {message_text(message)}\n"
+                for message in history[self.last_printed_index:]
+            )
             with open(self.log_file, 'a', encoding='utf-8') as f:
-                for i in range(self.last_printed_index, len(self.chat.history)):
-                    message = self.chat.history[i]
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    text_content = message.parts[0].text
-                    log_entry = f"[{timestamp}] {message.role} PLANNING EXPERT: {text_content}\n"
-                    f.write(log_entry)
-                self.last_printed_index = len(self.chat.history)
+                f.write(log_entries)
+            self.last_printed_index = len(history)
         except Exception as e:
             logger.error(f"Error saving chat history to file: {e}")
             raise
+
+    def _screenshot_part(self, screenshot):
+        """
+        Downscales the screenshot and encodes it as JPEG into an inline image part, once per screenshot.
+        """
+        last_screenshot, part = self._prepared_screenshot
+        if last_screenshot is not screenshot:
+            part = {"mime_type": "image/jpeg", "data": encode_image(screenshot, max_edge=SCREENSHOT_MAX_EDGE)}
+            self._prepared_screenshot = (screenshot, part)
+        return part
+
+    @with_retry()
+    def _send_message(self, content, **kwargs):
+        """
+        Sends a message to the planning chat, retrying with exponential backoff on transient API errors.
+        When the message carries a screenshot, the screenshots already in the history are deprecated first.
+        """
+        if isinstance(content, list) and not all(isinstance(part, str) for part in content):
+            self.chat.history = deprecate_observations(self.chat.history)
+        return self.chat.send_message(content, **kwargs)
+
+    def _trim_history(self) -> None:
+        """
+        Keeps the chat history within a sliding window so the prefill of every call stays bounded.
+
+        When the history holds twice `max_history_turns` turns, the oldest ones are summarized with a
+        one-shot call to the small model, outside the chat, and dropped, keeping the last `max_history_turns` turns. The
+        summary is prepended to the following prompts by `_with_history_summary`. Summarizing only once every
+        `max_history_turns` turns keeps the extra calls rare.
+        """
+        history = self.chat.history
+        window = 2 * self.max_history_turns  # a turn is a user message and a model message
+        if len(history) <= 2 * window:
+            return
+
+        dropped = history[:-window]
+        conversation = "\n".join(
+            f"{message.role}: {message_text(message)}" for message in dropped
+        )
+        prompt = HISTORY_SUMMARY_PROMPT_TEMPLATE.substitute(
+            previous_summary=self.history_summary or "None",
+            conversation=conversation
+        )
+        try:
+            self.history_summary = self.small_model.generate_content(prompt).text.strip()
+        except Exception as e:
+            # Losing part of the context is preferable to an unbounded history
+            logger.warning(f"Could not summarize the chat history of the planning expert: {e}")
+
+        self.chat.history = history[-window:]
+        self.last_printed_index = max(0, self.last_printed_index - len(dropped))
+
+    def _with_history_summary(self, prompt: str) -> str:
+        """
+        Prepends the main task and the summary of the dropped turns, if any, to a prompt.
+        """
+        if not self.history_summary:
+            return prompt
+        return f'The main task is: "{self.main_task}".\nSummary of the earlier conversation: {self.history_summary}\n{prompt}'
+
+    def _get_cached_response(self, fingerprint, prompt, entities=None):
+        """
+        Looks up the plan cache and, on a hit, replays the exchange into the chat history
+        so that the following prompts keep the same context as if the LLM had been called.
+
+        Args:
+            fingerprint (str): Key of the request in the plan cache.
+            prompt (str): The prompt that would have been sent to the LLM.
+            entities (list[str]): If given, the cached response is a template whose slots
+                                  are filled with these task specific values.
+
+        Returns:
+            str: The cached response text, or None on a miss or when the cache is disabled.
+        """
+        if self.plan_cache is None:
+            return None
+
+        response_text = self.plan_cache.get(fingerprint)
+        if response_text is not None:
+            if entities is not None:
+                response_text = fill_slots(response_text, entities)
+            logger.info("Plan cache hit, skipping the LLM call")
+            append_chat_turn(self.chat, prompt, response_text)
+        return response_text
+
+    def _store_cached_response(self, fingerprint, response_text) -> None:
+        """
+        Stores a successfully parsed response in the plan cache.
+        """
+        if self.plan_cache is not None:
+            self.plan_cache.put(fingerprint, response_text)
     
     def decompose_main_task(self, main_task, screenshot):
         """
@@ -174,16 +319,42 @@ class PlanningExpert:
 
         try:
             self.main_task = main_task
-            prompt = DECOMPOSE_MAIN_TASK_PROMPT_TEMPLATE.format(main_task=main_task)
-            response = self.chat.send_message([prompt, screenshot])
-
-            subtask = parse_llm_response(response.text)
+            prompt = self._with_history_summary("".join(
+                (DECOMPOSE_MAIN_TASK_PROMPT_PREFIX, main_task, DECOMPOSE_MAIN_TASK_PROMPT_SUFFIX)
+            ))
+
+            # The response format is part of the key, entries cached in another format are not reused
+            fingerprint = task_fingerprint("decompose_main_task/json", main_task, image=screenshot)
+            response_text = self._get_cached_response(fingerprint, prompt)
+            cache_hit = response_text is not None
+
+            # Tasks that only differ in their specific values (file names, quoted text, URLs) share a plan template
+            skeleton, entities = task_skeleton(main_task)
+            entities = [json.dumps(entity)[1:-1] for entity in entities]  # as they appear inside the JSON response
+            template_fingerprint = task_fingerprint("decompose_main_task_template/json", skeleton, image=screenshot)
+            if not cache_hit and entities:
+                response_text = self._get_cached_response(template_fingerprint, prompt, entities)
+                cache_hit = response_text is not None
+
+            if not cache_hit:
+                response_text = self._send_message(
+                    [prompt, self._screenshot_part(screenshot)],
+                    generation_config=SUBTASK_GENERATION_CONFIG
+                ).text
+
+            subtask = parse_llm_json(response_text, "subtask")["subtask"]
+            if not cache_hit:
+                self._store_cached_response(fingerprint, response_text)
+                template = parameterize(response_text, entities) if entities else None
+                if template is not None:
+                    self._store_cached_response(template_fingerprint, template)
                     
             logger.info(f"This is the subtask created by the planning expert: {subtask}")
 
             self.current_subtask = subtask
 
             self._save_chat_history_to_file()
+            self._trim_history()
 
             return self.current_subtask
     
@@ -191,129 +362,161 @@ class PlanningExpert:
             logger.error(f"Error in decompose_main_task() of planning_expert: {e}")
             raise
     
-    def is_main_task_done(self, screenshot) -> bool:
+    def decompose_subtask(self, screenshot) -> str:
         """
-        Determines if the main task is complete by querying a language model (LLM).
+        Decomposes the current active subtask into a detailed list of instructions/steps.
 
-        This function queries the LLM to assess if the entire `main_task` has reached completion,
-        following the execution of `self.current_subtask`. It constructs a prompt using the
-        `IS_LAST_TASK_PROMPT_TEMPLATE`, providing context with the `current_subtask`, `main_task`,
-        and a `screenshot` of the current GUI state. The LLM is expected to respond with a
-        definitive 'yes' (the main task is completed) or 'no' (there is still more work to do).
+        This function expands a higher-level subtask into a granular sequence of executable
+        instructions. It communicates with a language model (LLM), providing it with the
+        `self.current_subtask` and a `screenshot` of the current GUI state as context.
+        The LLM first drafts the instructions in plain text and then reviews them, answering
+        the revised list in JSON mode as an array of instructions, forming a list of actionable
+        steps suitable for an action execution expert.
 
         Args:
-            self: The instance of the class, expected to have `current_subtask`, `main_task`,
-                  and a `chat` object for LLM interaction.
-            screenshot: The image of the current GUI environment, providing visual context to the LLM.
+            self: The instance of the class, providing access to the `chat` object for
+                  LLM interaction and the `current_subtask` which needs decomposition.
+            screenshot: The current image of the GUI environment, providing visual
+                        and contextual information to the LLM for accurate subtask decomposition.
 
         Returns:
-            bool: True if the LLM responds 'yes' (meaning this *is* the last task and no more work is needed),
-                  False if the LLM responds 'no' (meaning there's *more* work to do)
+            list[str]: A list of strings, where each string is a distinct LLM-generated
+                       instruction for carrying out the subtask.
         """
         try:
-            prompt = IS_LAST_TASK_PROMPT_TEMPLATE.format(current_subtask=self.current_subtask, main_task = self.main_task)
-            response = self.chat.send_message([prompt, screenshot])
             
-            llm_response_text = parse_llm_response(response.text)
 
-            self._save_chat_history_to_file()
+            prompt = self._with_history_summary("".join(
+                (DECOMPOSE_SUBTASK_PROMPT_PREFIX, self.current_subtask, DECOMPOSE_SUBTASK_PROMPT_SUFFIX)
+            ))
+
+            # Only the reflected instruction list is cached, it is replayed as the answer to the first prompt
+            fingerprint = task_fingerprint("decompose_subtask/json", self.current_subtask, image=screenshot)
+            response_text = self._get_cached_response(fingerprint, prompt)
+            cache_hit = response_text is not None
+            if not cache_hit:
+                # The draft is free text, the reasoning is what the reflection reviews
+                self._send_message([prompt, self._screenshot_part(screenshot)])
+
+                prompt = DECOMPOSE_SUB_TASK_PROMPT_TEMPLATE_REFLECT
+                response_text = self._send_message(
+                    [prompt, self._screenshot_part(screenshot)],
+                    generation_config=INSTRUCTIONS_GENERATION_CONFIG
+                ).text
+
+            instruction_list = [instruction.strip() for instruction in parse_llm_json(response_text, "instructions")["instructions"] if instruction.strip()]
+            if not cache_hit:
+                self._store_cached_response(fingerprint, response_text)
+            logger.info(f"These are the instructions for the task: {instruction_list}")
 
-            return llm_response_text.lower() == 'yes'
+            self._save_chat_history_to_file()
+            self._trim_history()
+            
+            return instruction_list
         
         except Exception as e:
-            logger.error(f"Error in is_main_task_done() of planning_expert: {e}")
+            logger.error(f"Error in decompose_subtask() of planning_expert: {e}")
             raise
 
-    def rethink_subtask(self, reflection_expert_feedback: str, screenshot) -> None:
+    def _stream_plan_step(self, prompt, screenshot):
         """
-        Revises the current planning of subtasks based on feedback and the current GUI state.
+        Sends the plan step prompt with a streamed response and stops reading it as soon as
+        the "done" field is true, since nothing else is needed when the main task is done.
 
-        This function is invoked when a re-evaluation of the subtask plan is necessary,
-        for instance, due to an execution error, or after the successful completion of a previous subtask. 
-        It constructs a prompt for a language model (LLM), providing it with `reflection_expert_feedback`, 
-        the `self.current_subtask` just processed, the overall `self.main_task`, and the current `screenshot`.
-        The LLM is tasked with generating a new, updated subtask based on this comprehensive context.
-
-        The  newly generated subtask is then set as `self.current_subtask`, effectively updating the active task for the agent.
+        The dropped stream is not complete, so the chat history is restored to its previous state
+        and the exchange is appended with the answer received so far.
 
         Args:
-            self: The instance of the class, providing access to `chat` for LLM interaction,
-                  and `main_task` and `current_subtask` for context.
-            reflection_expert_feedback (str): Feedback from the reflection expert. This
-                                              string can be empty if the previous instruction
-                                              list was completed successfully, or it can
-                                              contain details about issues encountered.
-            screenshot: The current image of the GUI environment, providing visual context
-                        to the LLM for rethinking the plan.
+            prompt (str): The plan step prompt.
+            screenshot: The current image of the GUI environment.
 
         Returns:
-            str: The new subtask which becomes the new `self.current_subtask`.
+            tuple[bool, str]: Whether the main task is done and the response text received.
         """
-        try:
-            prompt = RETHINK_SUBTASK_PROMPT_TEMPLATE.format(
-                reflection_expert_feedback=reflection_expert_feedback,
-                current_subtask=self.current_subtask,
-                main_task=self.main_task
-            )
-            response = self.chat.send_message([prompt, screenshot])
-
-            subtask = parse_llm_response(response.text)
-
-            self.current_subtask = subtask
-
-            self._save_chat_history_to_file()
-
-            return subtask
-
-
-        except Exception as e:
-            logger.error(f"Error in rethink_subtask() of planning_expert: {e}")
-            raise
-    
-    def decompose_subtask(self, screenshot) -> str:
+        history = list(self.chat.history)
+        response = self._send_message(
+            [prompt, self._screenshot_part(screenshot)],
+            generation_config=PLAN_STEP_GENERATION_CONFIG,
+            stream=True
+        )
+
+        # A single iterator is shared by both loops, iterating the response again would restart from its first chunk
+        chunks = iter(response)
+        response_text = ""
+        for chunk in chunks:
+            response_text += chunk.text
+            match = _DONE_RE.search(response_text)
+            if match is None:
+                continue  # Not enough tokens yet to read the answer
+
+            if match.group(1) == "true":
+                response_text = '{"done": true}'
+                self.chat.history = history
+                append_chat_turn(self.chat, prompt, response_text)
+                return True, response_text
+            break  # false: the whole answer is needed
+
+        for chunk in chunks:
+            response_text += chunk.text
+        return False, response_text
+
+    def plan_step(self, reflection_expert_feedback: str, screenshot):
         """
-        Decomposes the current active subtask into a detailed list of instructions/steps.
+        Checks if the main task is done and, if not, plans and decomposes the next subtask in a single LLM call.
 
-        This function expands a higher-level subtask into a granular sequence of executable
-        instructions. It communicates with a language model (LLM), providing it with the
-        `self.current_subtask` and a `screenshot` of the current GUI state as context.
-        The LLM is expected to generate a detailed plan of actions, formatted as a
-        semicolon-separated string of instructions. The function then parses this raw
-        response by splitting it into individual instructions, forming a list of actionable
-        steps suitable for an action execution expert.
+        It is used both after a completed subtask and to replan after an error: asking separately if the main
+        task is done, for the next subtask and for its instructions would be sequential round-trips sending the
+        same screenshot. The LLM answers the three questions in a single JSON object ("done", "subtask" and "subtask_instructions"),
+        which is streamed so the call returns as soon as the main task is known to be done.
+        When the main task is not done the new subtask becomes `self.current_subtask`.
 
         Args:
-            self: The instance of the class, providing access to the `chat` object for
-                  LLM interaction and the `current_subtask` which needs decomposition.
-            screenshot: The current image of the GUI environment, providing visual
-                        and contextual information to the LLM for accurate subtask decomposition.
+            reflection_expert_feedback (str): Feedback from the reflection expert, empty if the
+                                              previous subtask was completed successfully.
+                                              Otherwise it describes the error and how to solve it.
+            screenshot: The current image of the GUI environment, providing visual context to the LLM.
 
         Returns:
-            list[str]: A list of strings, where each string is a distinct LLM-generated
-                       instruction for carrying out the subtask.
+            tuple[bool, list[str]]: Whether the main task is done and, if it is not, the instruction
+                                    list of the new subtask (empty when it is done).
         """
         try:
-            
+            # Feedback strings repeat verbatim across turns, share a single copy of them
+            if len(reflection_expert_feedback) < 8192:
+                reflection_expert_feedback = sys.intern(reflection_expert_feedback)
 
-            prompt = DECOMPOSE_SUBTASK_PROMPT_TEMPLATE.format(
+            prompt = self._with_history_summary(PLAN_STEP_PROMPT_TEMPLATE.substitute(
+                reflection_expert_feedback=reflection_expert_feedback,
                 current_subtask=self.current_subtask,
-            )
+                subtask_outcome=SUBTASK_FAILED if reflection_expert_feedback else SUBTASK_COMPLETED,
+                main_task=self.main_task
+            ))
+            done, response_text = self._stream_plan_step(prompt, screenshot)
+            if done:
+                self._save_chat_history_to_file()
+                self._trim_history()
+                return True, []
+
+            response = parse_llm_json(response_text, "done")
+            subtask = response.get("subtask", "").strip()
+            if not subtask:
+                raise ValueError(f"LLM response missing the next subtask: {response_text}")
+            self.current_subtask = subtask
+            logger.info(f"This is the subtask created by the planning expert: {subtask}")
 
-            response = self.chat.send_message([prompt, screenshot])
+            instruction_list = [instruction.strip() for instruction in response.get("subtask_instructions", []) if instruction.strip()]
+            self._save_chat_history_to_file()
+            self._trim_history()
 
-            prompt = DECOMPOSE_SUB_TASK_PROMPT_TEMPLATE_REFLECT
-            response = self.chat.send_message([prompt, screenshot])
+            if not instruction_list:
+                # The LLM planned the subtask but did not decompose it, fall back to the dedicated call
+                return False, self.decompose_subtask(screenshot)
 
-            instruction_list_str = parse_llm_response(response.text)
-            instruction_list = [task.strip() for task in instruction_list_str.split(';') if task.strip()]
             logger.info(f"These are the instructions for the task: {instruction_list}")
+            return False, instruction_list
 
-            self._save_chat_history_to_file()
-            
-            return instruction_list
-        
         except Exception as e:
-            logger.error(f"Error in decompose_subtask() of planning_expert: {e}")
+            logger.error(f"Error in plan_step() of planning_expert: {e}")
             raise
     
 
@@ -1,57 +1,111 @@
 import os
+import sys
+import time
+import atexit
 import logging
-from dotenv import load_dotenv
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 from PIL import Image
-from .utils import parse_llm_response
+from .utils import parse_llm_json, encode_image, image_digest, configure_gemini, get_model, with_retry
+from .plan_cache import ResponseCache, task_fingerprint
 from datetime import datetime
 
 
 logger = logging.getLogger("reflection_expert")
 
-FIRST_EVALUATE_EXECUTION_PROMPT = """
-Instruction: {instruction}
-
-Task:
+# Part of the verdict cache key, bump it whenever the reflection prompts change so stale verdicts are not reused
+REFLECTION_PROMPT_VERSION = "reflect-v2"
+VERDICT_CACHE_TTL_SECONDS = 60 * 60  # 1 hour
+VERDICT_CACHE_MAX_ENTRIES = 256
+
+# (prompt version, request, instruction, screenshot) fingerprint -> (response text, time stored).
+# Shared by every ReflectionExpert, so an instruction evaluated on the same screen by a new
+# expert (e.g. the next episode of the same task) is not sent to the LLM again.
+_verdict_cache = OrderedDict()
+_verdict_cache_lock = threading.Lock()
+
+# Where the verdicts come from: "memory", "disk" or "llm". Logged when the process exits,
+# updated under `_verdict_cache_lock` by the agents of every environment.
+verdict_cache_stats = Counter()
+
+
+@atexit.register
+def _log_verdict_cache_stats() -> None:
+    with _verdict_cache_lock:
+        stats = dict(verdict_cache_stats)
+    total = sum(stats.values())
+    if total:
+        reused = total - stats.get("llm", 0)
+        logger.info("Reflection verdicts: %s, %.0f%% served without calling the LLM", stats, 100 * reused / total)
+
+
+_persistent_verdicts = None
+_persistent_verdicts_lock = threading.Lock()
+
+
+def _get_persistent_verdicts() -> ResponseCache:
+    """
+    Provides the SQLite store behind the in-memory verdict cache, opened on first use and shared by every
+    ReflectionExpert, so the verdicts of a subtask that repeats across runs survive the process.
+    """
+    global _persistent_verdicts
+    with _persistent_verdicts_lock:
+        if _persistent_verdicts is None:
+            cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
+            os.makedirs(cache_dir, exist_ok=True)  # Create cache directory if it doesn't exist
+            _persistent_verdicts = ResponseCache(
+                os.path.join(cache_dir, 'verdict_cache.sqlite'), table="verdicts", ttl_seconds=VERDICT_CACHE_TTL_SECONDS
+            )
+        return _persistent_verdicts
+
+
+# Messages kept as context of the next calls: the last two (user, model) turns, enough for
+# `create_new_instruction` to see the last evaluation
+HISTORY_RING_SIZE = 4
+
+# Screenshots are sent downscaled to this long edge, enough to judge the GUI state
+SCREENSHOT_MAX_EDGE = 1024
+SCREENSHOT_JPEG_QUALITY = 80
+SCREENSHOT_WEBP_QUALITY = 75  # WebP is about half the size of JPEG at the same quality for GUI content
+# Encoded screenshots kept by content, so an unchanged screen is not encoded again in the next round
+PREPARED_SCREENSHOTS_MAX_ENTRIES = 8
+
+# Encodes and digests the screenshots in the background, PIL releases the GIL while it resizes and encodes
+_preprocessing_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="reflection-preprocessing")
+
+# Static rules of every reflection request. They are sent once as the system instruction of the model,
+# so each turn only carries the instruction and the screenshot and the static prefix stays byte-identical across calls.
+REFLECTION_SYSTEM_INSTRUCTION = """
+You are the Reflection Expert of an agent that operates a computer GUI with pyAutoGUI. You evaluate the instructions executed by the agent using a screenshot taken after their execution.
+If the screenshot suggests the screen is still loading (e.g., presence of a loading spinner, partial content, "Loading..." text, or a blank/white screen when content is expected), clearly state this.
+
+# Evaluating an execution
+Work through the three following steps before answering.
+
+Step 1: Identify the elements.
 Identify active application, window state, and visible UI elements (e.g., search bars, tabs, buttons) from the screenshot.
 Determine critical UI elements relevant to the instruction's execution. Include elements even if indirectly related.
 Describe the *expected state* of these elements after successful execution, reflecting the instruction's intended outcome.
 For hotkey actions (e.g., Ctrl+Shift+B), assume success even if not visually distinct.
 
-Output:
-Critical elements to inspect and their expected state after successful instruction execution.
-Additionally, if the screenshot suggests the screen is still loading (e.g., presence of a loading spinner, partial content, "Loading..." text, or a blank/white screen when content is expected), clearly state this.
-"""
-
-SECOND_EVALUATE_EXECUTION_PROMPT = """
-Task:
+Step 2: Analyze their current state.
 From the previously identified elements, select the most important ones relevant to the instruction's goal (e.g., address bar for typing, new tab for Ctrl+T).
-Analyze the screenshot to determine their current state.
+Analyze the screenshot to determine their current state and whether it matches the expected state.
 Pay special attention to drag bars (sliders), verifying their exact position matches the expected state (e.g., if expected at maximum, ensure it's at the far right/top).
 Trust visible elements in the screenshot (e.g., buttons, tabs). Assume hotkey actions (e.g., Ctrl+Shift+B) succeeded if not visually distinct.
 If ambiguous (e.g., multiple search bars), specify (e.g., 'browser’s address bar').
 
-Output:
-Detailed description of the most important elements' current state and reasoning on whether it matches the expected state.
-
-"""
-
-THIRD_EVALUATE_EXECUTION_PROMPT = """
-Task:
+Step 3: Verdict.
 Determine if the instruction was successfully executed, based on the previous analysis, expected element states, and the screenshot.
 Evaluate success by checking for changes or absence of elements the instruction aimed to alter, as the screenshot shows the *after* state.
 Rely on screenshot for visible changes (e.g., new folder, closed pop-up). Assume hotkey actions (e.g., Ctrl+T) succeeded.
 
 Output Structure:
-1. **Reasoning Process:** Your thought process.
-2. **Final Answer:** Respond 'yes' or 'no' on whether the instruction was successfully completed. Your response MUST start with 'RESPONSE:' on a new line.
-"""
-
-EVALUATE_ERROR_PROMPT = """
-Task:
-Classify the last error as 'Minor' or 'Major' based on the definitions below, considering the current instruction: {instruction}.
-Additionally, if the screenshot suggests the screen is still loading (e.g., presence of a loading spinner, partial content, "Loading..." text, or a blank/white screen when content is expected), clearly state this.
+Answer only with the JSON object {"ok": true} if the instruction was successfully completed, {"ok": false} otherwise.
 
+# Classifying an error
 Error Classification:
 
 * *Minor:* The instruction can be completed from the current screen with only one additional instruction. If more than one instruction is needed, it's a Major error.
@@ -68,61 +122,315 @@ Error Classification:
         * Tried to type on a search bar, but no search bar exists on the screen.
         * Tried to click a non-existent icon.
 
+Analyze the screenshot to classify the error. Consider the main task and if scrolling is needed.
+
 Output Structure:
-1.  *Reasoning Process:* Step-by-step thoughts on error classification and potential solutions. Analyze the screenshot to inform your thoughts. Consider the main task and if scrolling is needed.
-2.  *Revised Instruction:* What caused the error and a solution to resolve it. The response MUST start with 'RESPONSE:' on a new line, followed by 'Minor:' or 'Major:' and your solution.
+Answer only with a JSON object with the "severity" of the error, 'minor' or 'major', and the "fix": what caused the error and a solution to resolve it.
 
 Example of expected output:
-RESPONSE: Minor: You should click slightly more to the right.
+{"fix": "You should click slightly more to the right.", "severity": "minor"}
+"""
+
+# The static text goes first and the instruction last, so consecutive requests share the longest possible prefix
+EVALUATE_EXECUTION_PROMPT = """
+Evaluate whether the instruction was successfully executed.
+Instruction: {instruction}
 """
+# Split once around the instruction and filled by concatenation
+EVALUATE_EXECUTION_PROMPT_PREFIX, EVALUATE_EXECUTION_PROMPT_SUFFIX = EVALUATE_EXECUTION_PROMPT.split("{instruction}")
+
+# The evaluations are answered in JSON mode, a verdict is a single boolean so its decode is capped to a few tokens,
+# with room for whitespace if the model pretty-prints it
+EVALUATE_EXECUTION_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema={"type": "object", "properties": {"ok": {"type": "boolean"}}, "required": ["ok"]},
+    max_output_tokens=32,
+    temperature=0,
+)
+
+EVALUATE_ERROR_PROMPT = """
+Classify the last error as 'Minor' or 'Major' following the error classification.
+Instruction: {instruction}
+"""
+EVALUATE_ERROR_PROMPT_PREFIX, EVALUATE_ERROR_PROMPT_SUFFIX = EVALUATE_ERROR_PROMPT.split("{instruction}")
+
+EVALUATE_ERROR_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema={
+        "type": "object",
+        "properties": {
+            "fix": {"type": "string"},
+            "severity": {"type": "string", "format": "enum", "enum": ["minor", "major"]},
+        },
+        "required": ["fix", "severity"],
+    },
+    max_output_tokens=512,
+)
 
 
 class ReflectionExpert:
-    def __init__(self, model_id: str = "gemini-2.0-flash"):
+    def __init__(self, model_id: str = "gemini-2.0-flash", use_verdict_cache: bool = True):
         """
         Initialitation of the Reflexion Expert
+
+        Args:
+            model_id (str): Gemini model used for reflection.
+            use_verdict_cache (bool): Reuse the execution verdicts of an instruction already evaluated, by any
+                                      ReflectionExpert, on the same screenshot instead of asking the LLM again.
         """
-        load_dotenv()
-        gemini_api_key = os.getenv("GEMINI_API_KEY")
-        if not gemini_api_key:
+        try:
+            configure_gemini()
+        except ValueError:
             logger.error("GEMINI_API_KEY not found in the file .env for Reflection Expert")
-            raise ValueError("GEMINI_API_KEY not found in the file .env")
-        
-        genai.configure(api_key=gemini_api_key)
-        self.model = genai.GenerativeModel(model_id)
+            raise
 
-        self.chat = self.model.start_chat(history=[])
+        self.model = get_model(model_id, REFLECTION_SYSTEM_INSTRUCTION)
+
+        # Runs the speculative error evaluations of this expert only, so the agents of other environments
+        # do not queue behind it. Never shut down so that a discarded speculation does not block the caller.
+        self._speculation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="reflection")
+
+        # The calls are stateless, only the last turns are sent again instead of the whole conversation
+        self._ring = deque(maxlen=HISTORY_RING_SIZE)
+        # Error evaluations of the current instruction, kept apart from the ring so the LLM still sees
+        # every previous attempt when it decides whether a repeated minor error becomes major
+        self._error_turns = []
 
         self.instruction_list = []
         self.instruction_index = 0
         
-        self.last_printed_index = 0 # this is for printing the chat history for debugging
+        self._unsaved_messages = [] # messages not written to the log file yet, for debugging
+
+        # Module-level LRU shared by all instances and backed by `_get_persistent_verdicts`, None when disabled
+        self.verdict_cache = _verdict_cache if use_verdict_cache else None
+
+        # Last screenshot prepared by `_prepare_screenshot` and its inline part, shared by the evaluations of a step
+        self._prepared_screenshot = (None, None)
+        # screenshot digest -> inline part of the last screenshots prepared
+        self._prepared_parts = OrderedDict()
+        self._prepared_parts_lock = threading.Lock()
+
+        # Last screenshot digested and its exact digest, used by the verdict cache keys and `_prepared_parts`
+        self._digested_screenshot = (None, None)
+
+        # Screenshot being preprocessed by `prefetch_screenshot` and its future
+        self._prefetch = (None, None)
 
         # Set up log file directory and path
         self.log_dir = os.path.join(os.path.dirname(__file__), 'logs')
         os.makedirs(self.log_dir, exist_ok=True)  # Create logs directory if it doesn't exist
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.log_file = os.path.join(self.log_dir, f'chat_history_{timestamp}.log')
+        # Agents of different environments are created in their own threads, often in the same second
+        self.log_file = os.path.join(self.log_dir, f'chat_history_{timestamp}_{threading.current_thread().name}.log')
 
     def _save_chat_history_to_file(self):
         """
-        Saves the chat history to a log file since the last printed index.
+        Saves the messages exchanged since the last save to a log file.
         Each message includes a timestamp, role, and content.
+        The messages are buffered and written with a single call.
         """
         try:
-            with open(self.log_file, 'a', encoding='utf-8') as f:
-                for i in range(self.last_printed_index, len(self.chat.history)):
-                    message = self.chat.history[i]
-                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    text_content = message.parts[0].text
-                    log_entry = f"[{timestamp}] {message.role} REFLECTION EXPERT: {text_content}\n"
-                    f.write(log_entry)
-
-                self.last_printed_index = len(self.chat.history)
+            if self._unsaved_messages:
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                log_entries = "".join(
+                    f"[{timestamp}] {message['role']} REFLECTION EXPERT: {message['parts'][0]}\n"
+                    for message in self._unsaved_messages
+                )
+                with open(self.log_file, 'a', encoding='utf-8') as f:
+                    f.write(log_entries)
+
+                self._unsaved_messages = []
+
+            if self.verdict_cache is not None and logger.isEnabledFor(logging.DEBUG):
+                with _verdict_cache_lock:
+                    stats, entries = dict(verdict_cache_stats), len(self.verdict_cache)
+                logger.debug("Verdict cache: %s, %d entries in memory", stats, entries)
 
         except Exception as e:
-            logger.error(f"Error saving chat history to file: {e}")
+            logger.error("Error saving chat history to file: %s", e)
             raise
+
+    def _record_turn(self, prompt, response_text, error_evaluation: bool = False) -> None:
+        """
+        Adds a (user, model) exchange to the context ring and to the messages pending to be logged.
+        Screenshots are not kept, only the text of the exchange.
+        """
+        turn = ({"role": "user", "parts": [prompt]}, {"role": "model", "parts": [response_text]})
+        self._ring.extend(turn)
+        self._unsaved_messages.extend(turn)
+        if error_evaluation:
+            self._error_turns.extend(turn)
+
+    def _error_context(self) -> list:
+        """
+        Context of an error evaluation: the earlier error evaluations of the current instruction that
+        are no longer in the ring, followed by the ring.
+        """
+        in_ring = {id(message) for message in self._ring}
+        return [*(message for message in self._error_turns if id(message) not in in_ring), *self._ring]
+
+    @with_retry()
+    def _generate(self, prompt, screenshot=None, generation_config=None, context=None) -> str:
+        """
+        Calls the LLM statelessly with the recent turns as context followed by the new prompt,
+        retrying with exponential backoff on transient API errors.
+
+        Args:
+            prompt (str): The prompt of the request.
+            screenshot: Optional screenshot sent after the prompt.
+            generation_config: Optional generation config of the request.
+            context (list): Messages used as context, the current ring by default.
+
+        Returns:
+            str: The response text.
+        """
+        parts = [prompt] if screenshot is None else [prompt, self._prepare_screenshot(screenshot)]
+        contents = [*(self._ring if context is None else context), {"role": "user", "parts": parts}]
+        return self.model.generate_content(contents, generation_config=generation_config).text
+
+    def _prepare_screenshot(self, screenshot, prefetching: bool = False):
+        """
+        Downscales the screenshot and re-encodes it as WebP, or JPEG if PIL has no WebP support, before sending it to the LLM.
+
+        Full resolution PNG screenshots dominate the bytes uploaded and the image tokens prefilled
+        on every evaluation. The last prepared screenshot is kept, so the execution and error
+        evaluations of the same step encode it only once, and the last few are kept by content,
+        so a screenshot of an unchanged screen in a later round is not encoded again either.
+
+        Args:
+            screenshot (PIL Image): The screenshot of the GUI.
+            prefetching (bool): True when called from the background preprocessing itself.
+
+        Returns:
+            dict: Inline image part ({"mime_type", "data"}) to send in place of the screenshot.
+        """
+        if not prefetching:
+            self._wait_for_prefetch(screenshot)
+        last_screenshot, part = self._prepared_screenshot
+        if last_screenshot is screenshot:
+            return part
+
+        digest = self._screenshot_digest(screenshot, prefetching=True)
+        with self._prepared_parts_lock:
+            part = self._prepared_parts.get(digest)
+            if part is not None:
+                self._prepared_parts.move_to_end(digest)
+        if part is not None:
+            self._prepared_screenshot = (screenshot, part)
+            return part
+
+        try:
+            data = encode_image(screenshot, max_edge=SCREENSHOT_MAX_EDGE, quality=SCREENSHOT_WEBP_QUALITY,
+                                resample=Image.LANCZOS, image_format="WEBP")
+            part = {"mime_type": "image/webp", "data": data}
+        except (KeyError, OSError):
+            data = encode_image(screenshot, max_edge=SCREENSHOT_MAX_EDGE, quality=SCREENSHOT_JPEG_QUALITY,
+                                resample=Image.LANCZOS, optimize=True)
+            part = {"mime_type": "image/jpeg", "data": data}
+        self._prepared_screenshot = (screenshot, part)
+        with self._prepared_parts_lock:
+            self._prepared_parts[digest] = part
+            while len(self._prepared_parts) > PREPARED_SCREENSHOTS_MAX_ENTRIES:
+                self._prepared_parts.popitem(last=False)
+        return part
+
+    def prefetch_screenshot(self, screenshot) -> None:
+        """
+        Starts encoding and digesting a new screenshot in a background thread, so the work overlaps with
+        whatever the caller does before the evaluation (e.g. the perception of the same screenshot).
+
+        Args:
+            screenshot (PIL Image): The screenshot that will be evaluated next.
+        """
+        self._prefetch = (screenshot, _preprocessing_executor.submit(self._prepare_screenshot, screenshot, prefetching=True))
+
+    def _wait_for_prefetch(self, screenshot) -> None:
+        """
+        Waits for the background preprocessing of `screenshot`, if it was prefetched, so it is not done twice.
+        """
+        prefetched_screenshot, future = self._prefetch
+        if prefetched_screenshot is screenshot and not future.done():
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning("Screenshot prefetch failed, preprocessing it again: %s", e)
+
+    def _screenshot_digest(self, screenshot, prefetching: bool = False) -> bytes:
+        """
+        Exact digest of the screenshot pixels, computed once per screenshot.
+        """
+        if not prefetching:
+            self._wait_for_prefetch(screenshot)
+        last_screenshot, digest = self._digested_screenshot
+        if last_screenshot is not screenshot:
+            digest = image_digest(screenshot)
+            self._digested_screenshot = (screenshot, digest)
+        return digest
+
+    def _verdict_fingerprint(self, request, instruction, screenshot) -> str:
+        """
+        Key of a request in the verdict cache, built from the digest of the screenshot so the
+        pixels are hashed once for all the requests of a step.
+        """
+        return task_fingerprint(REFLECTION_PROMPT_VERSION, request, instruction, self._screenshot_digest(screenshot).hex())
+
+    def _get_cached_verdict(self, fingerprint, prompt):
+        """
+        Looks up the verdict cache, in memory and then on disk, and, on a hit, records the exchange as if
+        the LLM had been called so that `create_new_instruction` still sees the last evaluation.
+
+        Args:
+            fingerprint (str): Key of the request in the verdict cache.
+            prompt (str): The prompt that would have been sent to the LLM.
+
+        Returns:
+            str: The cached response text, or None on a miss or when the cache is disabled.
+        """
+        if self.verdict_cache is None:
+            return None
+
+        with _verdict_cache_lock:
+            entry = self.verdict_cache.get(fingerprint)
+            if entry is not None and time.monotonic() - entry[1] <= VERDICT_CACHE_TTL_SECONDS:
+                self.verdict_cache.move_to_end(fingerprint)
+                response_text = entry[0]
+                source = "memory"
+            else:
+                response_text = None
+
+        if response_text is None:
+            response_text = _get_persistent_verdicts().get(fingerprint)
+            if response_text is None:
+                return None
+            source = "disk"
+            self._store_verdict(fingerprint, response_text, persist=False)
+
+        with _verdict_cache_lock:
+            verdict_cache_stats[source] += 1
+        logger.info("Verdict cache hit (%s), skipping the LLM call", source)
+        self._record_turn(prompt, response_text)
+        return response_text
+
+    def _store_verdict(self, fingerprint, response_text, persist: bool = True) -> None:
+        """
+        Stores a successfully parsed response in the verdict cache, dropping the least recently used entries.
+
+        Args:
+            fingerprint (str): Key of the request in the verdict cache.
+            response_text (str): The response of the LLM.
+            persist (bool): Also write it to the persistent store, False when it was read from there.
+        """
+        if self.verdict_cache is None:
+            return
+
+        with _verdict_cache_lock:
+            self.verdict_cache[fingerprint] = (response_text, time.monotonic())
+            self.verdict_cache.move_to_end(fingerprint)
+            while len(self.verdict_cache) > VERDICT_CACHE_MAX_ENTRIES:
+                self.verdict_cache.popitem(last=False)
+
+        if persist:
+            _get_persistent_verdicts().put(fingerprint, response_text)
     
 
     def set_subtask_and_instructions(self, instruction_list) -> None:
@@ -148,40 +456,66 @@ class ReflectionExpert:
                   `self.instruction_index`.
         """
 
-        self.instruction_list = instruction_list
+        # Every instruction is sent and hashed several times, share a single copy of each
+        self.instruction_list = [sys.intern(instruction) for instruction in instruction_list]
         self.instruction_index = 0
 
+        # The turns of the previous subtask are not relevant to the new one, do not send them again
+        self._ring.clear()
+        self._error_turns.clear()
+
     
 
-    def evaluate_execution(self, screenshot):
+    def evaluate_execution(self, screenshot, on_cache_miss=None):
         """
-        Evaluates the success of an executed instruction by interacting with a language model
-        (LLM) in a multi-step conversational process.
+        Evaluates the success of an executed instruction with a single language model (LLM) call.
+        The LLM answers in JSON mode with a single boolean ("ok"), so the decode is a few tokens.
 
         Args:
-            self: The instance of the class, expected to have a `chat` object for sending messages
+            self: The instance of the class, expected to have a `model` for the LLM calls
                 and an `instruction_list` with the `instruction_index` pointing to the current instruction.
             screenshot: The image representing the state of the GUI after the instruction was executed.
+            on_cache_miss (callable): Optional function called when the verdict is not cached,
+                                      right before the LLM is asked.
 
         Returns:
-            bool: True if the LLM determines the instruction was successfully completed ('yes'),
-                False otherwise ('no').
+            bool: True if the LLM determines the instruction was successfully completed,
+                False otherwise.
         """
         try:
-            prompt = FIRST_EVALUATE_EXECUTION_PROMPT.format(instruction = self.instruction_list[self.instruction_index])
-            response = self.chat.send_message([prompt, screenshot])
-            response = self.chat.send_message(SECOND_EVALUATE_EXECUTION_PROMPT)
-            response = self.chat.send_message(THIRD_EVALUATE_EXECUTION_PROMPT)
-
-            final_response = parse_llm_response(response.text)
-
-            logger.info("Did the execution went well? " + final_response)
+            instruction = self.instruction_list[self.instruction_index]
+            prompt = "".join((EVALUATE_EXECUTION_PROMPT_PREFIX, instruction, EVALUATE_EXECUTION_PROMPT_SUFFIX))
+
+            # The same instruction re-evaluated on exactly the same screen (e.g. in a retry loop) gets the same verdict
+            fingerprint = self._verdict_fingerprint("evaluate_execution", instruction, screenshot)
+            response_text = self._get_cached_verdict(fingerprint, prompt)
+            cache_hit = response_text is not None
+            if not cache_hit:
+                if on_cache_miss is not None:
+                    on_cache_miss()
+                response_text = self._generate(prompt, screenshot, EVALUATE_EXECUTION_GENERATION_CONFIG)
+
+            try:
+                successful = parse_llm_json(response_text, "ok")["ok"] is True
+                valid = True
+            except ValueError as e:
+                # A truncated (MAX_TOKENS) or malformed verdict is taken as a failure, and the error evaluation decides
+                logger.warning("Invalid execution verdict, taking it as failed: %s", e)
+                successful = valid = False
+            if not cache_hit:
+                self._record_turn(prompt, response_text)
+                if valid:
+                    self._store_verdict(fingerprint, response_text)
+                with _verdict_cache_lock:
+                    verdict_cache_stats["llm"] += 1
+
+            logger.info("Did the execution went well? %s", successful)
 
             self._save_chat_history_to_file()
-            return final_response.lower() == 'yes'
+            return successful
         
         except Exception as e:
-            logger.error(f"Error in evaluate_execution: {e}")
+            logger.error("Error in evaluate_execution: %s", e)
             raise
     
     def is_last_instruction(self) -> bool:
@@ -200,7 +534,8 @@ class ReflectionExpert:
             bool: True if the `instruction_index` points to the last element of
                 `instruction_list`, False otherwise.
         """
-        return len(self.instruction_list) - 1 == self.instruction_index
+        instruction_list, index = self.instruction_list, self.instruction_index
+        return index == len(instruction_list) - 1
     
     def create_new_instruction(self):
         """
@@ -214,16 +549,19 @@ class ReflectionExpert:
         original `instruction_list` as if no error had occurred.
 
         Args:
-            None as it has all the information in the chat history.
+            None as it has all the information in the recent turns and the last evaluated screenshot.
 
         Returns:
             str: The newly generated single instruction from the LLM.
         """
         prompt = "Taking into account the last evaluation, respond only with the next instruction. don't add any comments."
-        response =self.chat.send_message(prompt)
+        # The ring only keeps text, the instruction is written looking at the screenshot that was just evaluated
+        screenshot, _ = self._prepared_screenshot
+        response_text = self._generate(prompt, screenshot)
+        self._record_turn(prompt, response_text)
         self._save_chat_history_to_file()
 
-        return response.text
+        return response_text
 
     
     def get_next_instruction(self):
@@ -242,46 +580,118 @@ class ReflectionExpert:
         Returns:
             str: The instruction string at the newly incremented `instruction_index`.
         """
-        self.instruction_index += 1
-        return self.instruction_list[self.instruction_index]
+        index = self.instruction_index + 1
+        self.instruction_index = index
+        self._error_turns.clear()  # the errors of the previous instruction do not count for this one
+        return self.instruction_list[index]
     
-    def evaluate_error(self, screenshot):
+    def evaluate_error(self, screenshot, speculative_response: str = None):
         """
         Evaluates a detected error by querying a language model (LLM) to classify it
         as minor or major and suggest solutions.
 
         This function sends the current instruction, and a screenshot to the LLM. 
-        The LLM then provides a detailed response that includes a reasoning process, 
-        identifies the cause of the error, and proposes solutions. The error
+        The LLM answers in JSON mode with the severity of the error and a fix that
+        identifies the cause of the error and proposes a solution. The error
         classification (minor or major) is based on specific criteria defined in the
-        `EVALUATE_ERROR_PROMPT`, primarily whether the error can be resolved with a
+        system instruction of the model, primarily whether the error can be resolved with a
         single follow-up instruction.
 
         Args:
-            self: The instance of the class, providing access to the `chat` object
+            self: The instance of the class, providing access to the `model`
                 for LLM interaction and the `instruction_list` with the current `instruction_index`.
             screenshot: The image representing the current state of the GUI where the
                         error occurred.
+            speculative_response (str): Response already obtained by `_speculate_error`, if any.
+                                        It is recorded instead of calling the LLM.
 
         Returns:
-            str: The LLM's response, stripped of the "RESPONSE:" prefix, which
-                contains the error classification (e.g., "Minor: ...", "Major: ...")
-                and proposed solutions.
+            tuple[str, str]: The severity of the error, "minor" or "major", and the proposed solution.
         """
         try:
 
-            prompt = EVALUATE_ERROR_PROMPT.format(instruction = self.instruction_list[self.instruction_index])
-            response =self.chat.send_message([screenshot, prompt])
+            instruction = self.instruction_list[self.instruction_index]
+            prompt = "".join((EVALUATE_ERROR_PROMPT_PREFIX, instruction, EVALUATE_ERROR_PROMPT_SUFFIX))
 
-            logger.info("This is the response of the reflection expert: " + response.text)
+            # Never reused from a previous evaluation: the same error seen again after a fix is how
+            # the LLM escalates a repeated minor error to a major one
+            if speculative_response is not None:
+                response_text = speculative_response
+            else:
+                response_text = self._generate(
+                    prompt, screenshot, EVALUATE_ERROR_GENERATION_CONFIG, context=self._error_context()
+                )
 
-            final_response = parse_llm_response(response.text)
+            logger.info("This is the response of the reflection expert: %s", response_text)
+
+            self._record_turn(prompt, response_text, error_evaluation=True)
             self._save_chat_history_to_file()
-            return final_response
+            try:
+                response = parse_llm_json(response_text, "severity", "fix")
+            except ValueError as e:
+                # A truncated (MAX_TOKENS) or malformed answer has no reliable severity, the planning expert replans
+                logger.warning("Invalid error evaluation, taking it as major: %s", e)
+                return "major", response_text.strip()
+            # Normalized once here, so the callers compare the severity without any string processing
+            severity = "minor" if response["severity"].strip().lower() == "minor" else "major"
+            return severity, response["fix"].strip()
         
         except Exception as e:
-            logger.error(f"Error in evaluate_error: {e}")
+            logger.error("Error in evaluate_error: %s", e)
             raise
     
+    def _speculate_error(self, context, screenshot):
+        """
+        Requests the error evaluation of the current instruction with `context` as the previous turns
+        (a snapshot of `_error_context`), so it can run while `evaluate_execution` is in progress.
+
+        Returns:
+            str: The response text.
+        """
+        instruction = self.instruction_list[self.instruction_index]
+        prompt = "".join((EVALUATE_ERROR_PROMPT_PREFIX, instruction, EVALUATE_ERROR_PROMPT_SUFFIX))
+        return self._generate(prompt, screenshot, EVALUATE_ERROR_GENERATION_CONFIG, context=context)
+
+    def evaluate_execution_and_error(self, screenshot):
+        """
+        Evaluates the last execution and, if it failed, the error, running both LLM calls concurrently.
+
+        Calling `evaluate_error` only after `evaluate_execution` returned False costs two sequential
+        round-trips on every failure. Instead, when the execution verdict is not cached, the error evaluation
+        is started speculatively on a snapshot of its context while the LLM evaluates the execution. When the
+        execution succeeded its result is discarded, otherwise it is recorded as if `evaluate_error` had been
+        called afterwards. A cached verdict answers at once, so no speculative call is paid for it.
+
+        Args:
+            screenshot: The image representing the state of the GUI after the instruction was executed.
+
+        Returns:
+            tuple[bool, tuple[str, str]]: Whether the instruction was successfully executed and, if it was not,
+                                          the (severity, solution) error evaluation of `evaluate_error`, None otherwise.
+        """
+        # Encoded and digested once, before both threads need them
+        self._prepare_screenshot(screenshot)
+
+        speculation = None
+
+        def speculate():
+            nonlocal speculation
+            speculation = self._speculation_executor.submit(self._speculate_error, self._error_context(), screenshot)
+
+        if self.evaluate_execution(screenshot, on_cache_miss=speculate):
+            if speculation is not None:
+                speculation.cancel()  # a running call cannot be cancelled, its result is simply ignored
+            return True, None
+
+        speculative_response = None
+        if speculation is not None:
+            try:
+                speculative_response = speculation.result()
+            except Exception as e:
+                logger.warning("Speculative error evaluation failed, evaluating it again: %s", e)
+
+        return False, self.evaluate_error(screenshot, speculative_response)
+
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
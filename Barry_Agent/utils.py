@@ -1,20 +1,241 @@
-def parse_llm_response(response_text: str) -> str:
+import io
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import functools
+from PIL import Image
+from dotenv import load_dotenv
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger("utils")
+
+# Replaces the images of the chat history that a more recent screenshot made obsolete
+DEPRECATED_OBSERVATION = "[DEPRECATED — superseded by a more recent observation]"
+
+# Errors of the Gemini API that are worth retrying: rate limits, overload, timeouts and dropped connections
+TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    TimeoutError,
+    ConnectionError,
+)
+
+
+@functools.lru_cache(maxsize=1)
+def configure_gemini() -> str:
+        """
+        Loads the GEMINI_API_KEY from the .env file and configures the Gemini client with it.
+
+        It only runs once per process, so creating more experts does not parse the .env file
+        or reconfigure the client again. A failure is not cached and is retried on the next call.
+
+        Returns:
+            str: The Gemini API key.
+
+        Raises:
+            ValueError: If GEMINI_API_KEY is not set.
+        """
+        load_dotenv()
+        gemini_api_key = os.getenv("GEMINI_API_KEY")
+        if not gemini_api_key:
+            raise ValueError("GEMINI_API_KEY not found in the file .env")
+
+        # gRPC keeps a single multiplexed connection for all the calls of the process
+        genai.configure(api_key=gemini_api_key, transport="grpc")
+        return gemini_api_key
+
+
+@functools.lru_cache(maxsize=None)
+def get_model(model_id: str, system_instruction: str = None):
+        """
+        Provides the Gemini model for `model_id` and `system_instruction`, created once per process and
+        shared by every expert.
+
+        A model holds no conversation state (chats keep their own history), and all the models
+        of the process send their requests through the single client set up by `configure_gemini`,
+        so sharing them avoids building the same objects again for every expert or episode.
+
+        Args:
+            model_id (str): Gemini model name.
+            system_instruction (str): Optional system instruction of the model.
+
+        Returns:
+            genai.GenerativeModel: The shared model.
         """
-        Parses the text response from an LLM, expecting a "RESPONSE:" prefix.
+        return genai.GenerativeModel(model_id, system_instruction=system_instruction)
+
 
-        This helper function extracts the relevant content from the LLM's response
-        by splitting it at the "RESPONSE:" delimiter and stripping any leading/trailing
-        whitespace. It raises a ValueError if the expected prefix is not found.
+def parse_llm_json(response_text: str, *keys: str) -> dict:
+        """
+        Parses an LLM response produced in JSON mode (`response_mime_type="application/json"`).
 
         Args:
-            response_text (str): The raw text response received from the LLM.
+            response_text (str): The raw JSON text received from the LLM.
+            *keys (str): Fields that must be present in the response.
 
         Returns:
-            str: The extracted content after the "RESPONSE:" prefix.
+            dict: The decoded response.
+
+        Raises:
+            ValueError: If the response is not a JSON object or lacks one of the required fields.
+        """
+        response = json.loads(response_text)
+        if not isinstance(response, dict):
+            raise ValueError(f"LLM response is not a JSON object: {response_text}")
+        missing = [key for key in keys if key not in response]
+        if missing:
+            raise ValueError(f"LLM response missing the fields {missing}: {response_text}")
+        return response
+
+
+def image_digest(image) -> bytes:
         """
-        parts = response_text.split("RESPONSE:", 1)
-        if len(parts) < 2:
-            raise ValueError(f"LLM response missing 'RESPONSE:' prefix: {response_text}")
-        
-        return parts[1].strip()
+        Computes an exact digest of a PIL image based on its pixels, size and mode.
 
+        Args:
+            image (PIL Image): The image to hash.
+
+        Returns:
+            bytes: 16 bytes BLAKE2b digest of the image.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{image.mode}{image.size}".encode("utf-8"))
+        digest.update(image.tobytes())
+        return digest.digest()
+
+
+def message_text(message) -> str:
+        """
+        Text of a chat history message. Image and file parts carry no text and are skipped instead
+        of raising, and so are messages without parts.
+
+        Args:
+            message: A message of `chat.history`.
+
+        Returns:
+            str: The text parts of the message joined by spaces.
+        """
+        return " ".join(text for text in (getattr(part, "text", "") for part in message.parts) if text)
+
+
+def deprecate_observations(history) -> list:
+        """
+        Replaces the images (inline data or uploaded files) of a chat history with the
+        DEPRECATED_OBSERVATION text, so only the screenshot sent next is billed as image tokens.
+
+        Messages without images are kept as they are, so deprecating an already deprecated
+        history changes nothing.
+
+        Args:
+            history (list): The `chat.history` to rewrite.
+
+        Returns:
+            list: The new history, to assign back to `chat.history`.
+        """
+        deprecated_history = []
+        for message in history:
+            if all(getattr(part, "text", "") for part in message.parts):
+                deprecated_history.append(message)
+                continue
+
+            parts = []
+            for part in message.parts:
+                text = getattr(part, "text", "")
+                if text:
+                    parts.append(text)
+                elif DEPRECATED_OBSERVATION not in parts:
+                    parts.append(DEPRECATED_OBSERVATION)
+            deprecated_history.append({"role": message.role, "parts": parts})
+        return deprecated_history
+
+
+def append_chat_turn(chat, user_text: str, model_text: str) -> None:
+        """
+        Appends a user/model exchange to a chat without calling the LLM.
+
+        Used when a response is served from a cache, so that later prompts which rely on
+        the previous turns ("taking into account the last evaluation...") still see it.
+
+        Args:
+            chat: The Gemini chat session whose history is extended.
+            user_text (str): The prompt that would have been sent.
+            model_text (str): The response of the model to that prompt.
+        """
+        chat.history = chat.history + [
+            {"role": "user", "parts": [user_text]},
+            {"role": "model", "parts": [model_text]},
+        ]
+
+
+def encode_image(image, max_edge: int = 768, quality: int = 85, resample=Image.BILINEAR, optimize: bool = False,
+                 image_format: str = "JPEG") -> bytes:
+        """
+        Downscales an image so its long edge is at most `max_edge` pixels and encodes it as JPEG (or WebP).
+
+        Gemini bills images by tile area, so a smaller picture means fewer image tokens to
+        prefill and fewer bytes to upload, while the GUI stays legible for planning purposes.
+
+        Args:
+            image (PIL Image): The image to encode.
+            max_edge (int): Maximum length in pixels of the long edge.
+            quality (int): JPEG quality.
+            resample: PIL resampling filter used for the downscale.
+            optimize (bool): Spend an extra encoder pass to shrink the JPEG further.
+            image_format (str): "JPEG" or "WEBP".
+
+        Returns:
+            bytes: The encoded image.
+
+        Raises:
+            KeyError, OSError: If PIL was built without support for `image_format`.
+        """
+        width, height = image.size
+        scale = max_edge / max(width, height)
+        if scale < 1:
+            image = image.resize((int(width * scale), int(height * scale)), resample)
+
+        buffer = io.BytesIO()
+        if image_format == "WEBP":
+            image.convert("RGB").save(buffer, format="WEBP", quality=quality, method=4)
+        else:
+            image.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=optimize)
+        return buffer.getvalue()
+
+
+def with_retry(max_attempts: int = 4, base_delay: float = 1.0, max_delay: float = 16.0, jitter: float = 1.0):
+        """
+        Decorator that retries a call to the Gemini API with exponential backoff when it fails
+        with a transient error, so a network blip does not abort the whole episode.
+
+        A random jitter is added to every wait, so the experts and environments that hit the same
+        rate limit at once do not retry in lockstep.
+
+        Args:
+            max_attempts (int): Maximum number of attempts, including the first one.
+            base_delay (float): Seconds waited after the first failure, doubled after every new failure.
+            max_delay (float): Upper bound of the wait between attempts.
+            jitter (float): Upper bound of the random seconds added to every wait.
+
+        Returns:
+            The decorator. Errors that are not transient, or the last transient one, are raised.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                for attempt in range(1, max_attempts + 1):
+                    try:
+                        return function(*args, **kwargs)
+                    except TRANSIENT_ERRORS as e:
+                        if attempt == max_attempts:
+                            raise
+                        delay = min(max_delay, base_delay * 2 ** (attempt - 1) + random.uniform(0, jitter))
+                        logger.warning(f"{function.__qualname__} failed ({e}), retrying in {delay:.1f}s ({attempt}/{max_attempts})")
+                        time.sleep(delay)
+            return wrapper
+        return decorator
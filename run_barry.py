@@ -1,9 +1,14 @@
 import argparse
+import atexit
 import datetime
 import json
 import logging
+import logging.handlers
 import os
 import sys
+import queue
+import statistics
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
@@ -44,10 +49,25 @@ sdebug_handler.setFormatter(formatter)
 stdout_handler.addFilter(logging.Filter("desktopenv"))
 sdebug_handler.addFilter(logging.Filter("desktopenv"))
 
-logger.addHandler(file_handler)
-logger.addHandler(debug_handler)
+# Los ficheros de log se escriben por bloques: los registros se acumulan en memoria y se vuelcan
+# cada LOG_BUFFER_CAPACITY registros, al llegar un WARNING o superior, o al terminar el proceso
+LOG_BUFFER_CAPACITY = 1024
+
+def buffered(handler: logging.Handler) -> logging.handlers.MemoryHandler:
+    """
+    Envuelve un handler de fichero en un MemoryHandler con su mismo nivel.
+    """
+    memory_handler = logging.handlers.MemoryHandler(
+        LOG_BUFFER_CAPACITY, flushLevel=logging.WARNING, target=handler
+    )
+    memory_handler.setLevel(handler.level)
+    atexit.register(memory_handler.flush)
+    return memory_handler
+
+logger.addHandler(buffered(file_handler))
+logger.addHandler(buffered(debug_handler))
 logger.addHandler(stdout_handler)
-logger.addHandler(sdebug_handler)
+logger.addHandler(buffered(sdebug_handler))
 
 logger = logging.getLogger("desktopenv.experiment")
 
@@ -73,6 +93,10 @@ def config() -> argparse.Namespace:
     parser.add_argument("--screen_height", type=int, default=1080)
     parser.add_argument("--sleep_after_execution", type=float, default=0.0)
     parser.add_argument("--max_steps", type=int, default=15)
+    parser.add_argument(
+        "--num_envs", type=int, default=1,
+        help="Number of environments run in parallel, each one in its own thread with its own VM (more than 1 requires leaving --path_to_vm unset)"
+    )
 
     # Agent config
     parser.add_argument("--test_config_base_dir", type=str, default="evaluation_examples")
@@ -92,14 +116,19 @@ def config() -> argparse.Namespace:
     
     return args
 
-def test(args: argparse.Namespace, test_all_meta: dict) -> None:
+def load_example(config_file: str) -> dict:
     """
-    Ejecuta la evaluación para todas las tareas definidas en test_all_meta.
+    Lee la configuración JSON de un ejemplo de evaluación.
     """
-    scores = []
-    max_steps = args.max_steps
+    with open(config_file, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-    logger.info("Args: %s", args)
+def run_example(agent: BarryAgent, env: DesktopEnv, domain: str, example_id: str, example: dict,
+                args: argparse.Namespace, scores: list) -> None:
+    """
+    Ejecuta un único ejemplo de evaluación con el agente y el entorno dados y escribe su result.txt.
+    """
+    max_steps = args.max_steps
     cfg_args = {
         "path_to_vm": args.path_to_vm,
         "headless": args.headless,
@@ -113,117 +142,160 @@ def test(args: argparse.Namespace, test_all_meta: dict) -> None:
         "result_dir": args.result_dir,
     }
 
-    agent = BarryAgent(
-        model=args.model, 
-        action_space=args.action_space,
-        observation_type=args.observation_type,
-    )
+    logger.info("[Domain]: %s", domain)
+    logger.info("[Example ID]: %s", example_id)
 
-    env = DesktopEnv(
-        path_to_vm=args.path_to_vm,
-        action_space=agent.action_space,
-        screen_size=(args.screen_width, args.screen_height),
-        headless=args.headless,
-        os_type="Ubuntu",
-        require_a11y_tree=args.observation_type in ["a11y_tree", "screenshot_a11y_tree", "som"],
-    )
+    instruction = example["instruction"]
+    logger.info("[Instruction]: %s", instruction)
+    cfg_args["instruction"] = instruction
+    cfg_args["start_time"] = datetime.datetime.now().strftime("%Y:%m:%d-%H:%M:%S")
 
-    for domain in tqdm(test_all_meta, desc="Domain"):
-        for example_id in tqdm(test_all_meta[domain], desc="Example", leave=False):
-            config_file = os.path.join(
-                args.test_config_base_dir, f"examples/{domain}/{example_id}.json"
-            )
-            with open(config_file, "r", encoding="utf-8") as f:
-                example = json.load(f)
-
-            logger.info(f"[Domain]: {domain}")
-            logger.info(f"[Example ID]: {example_id}")
-
-            instruction = example["instruction"]
-            logger.info(f"[Instruction]: {instruction}")
-            cfg_args["instruction"] = instruction
-            cfg_args["start_time"] = datetime.datetime.now().strftime("%Y:%m:%d-%H:%M:%S")
-
-            example_result_dir = os.path.join(
-                args.result_dir,
-                args.action_space,
-                args.observation_type,
-                args.model,   # CAMBIO: Usar args.model consistentemente
-                domain,
-                example_id,
-            )
-            os.makedirs(example_result_dir, exist_ok=True)
+    example_result_dir = os.path.join(
+        args.result_dir,
+        args.action_space,
+        args.observation_type,
+        args.model,   # CAMBIO: Usar args.model consistentemente
+        domain,
+        example_id,
+    )
+    os.makedirs(example_result_dir, exist_ok=True)
+
+    try:
+        logger.info("Starting evaluation for %s/%s", domain, example_id)
+
+        # CRÍTICO: Asegurar que lib_run_single.run_single_example escriba result.txt
+        logger.info("Aquí se llama a run_single_example con este env %s", env)
+        lib_run_single.run_single_example(
+            agent,
+            env,
+            example,
+            max_steps,
+            instruction,
+            args,
+            example_result_dir,
+            scores,
+        )
 
+        # CRÍTICO: Verificar que result.txt fue creado después de la ejecución
+        result_file = os.path.join(example_result_dir, "result.txt")
+        if not os.path.exists(result_file):
+            logger.error("CRÍTICO: result.txt no fue creado para %s/%s", domain, example_id)
+            logger.error("Esto indica un problema en lib_run_single.run_single_example")
+            # Crear result.txt con score 0 como fallback
+            with open(result_file, "w") as f:
+                f.write("0.0")
+            scores.append(0.0)
+        else:
+            # Verificar que el contenido del archivo es válido
             try:
-                logger.info(f"Starting evaluation for {domain}/{example_id}")
-                
-                # CRÍTICO: Asegurar que lib_run_single.run_single_example escriba result.txt
-                logger.info(f"Aquí se llama a run_single_example con este env {env}")
-                lib_run_single.run_single_example(
-                    agent,
-                    env,
-                    example,
-                    max_steps,
-                    instruction,
-                    args,
-                    example_result_dir,
-                    scores,
-                )
-                
-                # CRÍTICO: Verificar que result.txt fue creado después de la ejecución
-                result_file = os.path.join(example_result_dir, "result.txt")
-                if not os.path.exists(result_file):
-                    logger.error(f"CRÍTICO: result.txt no fue creado para {domain}/{example_id}")
-                    logger.error("Esto indica un problema en lib_run_single.run_single_example")
-                    # Crear result.txt con score 0 como fallback
-                    with open(result_file, "w") as f:
-                        f.write("0.0")
-                    scores.append(0.0)
-                else:
-                    # Verificar que el contenido del archivo es válido
-                    try:
-                        with open(result_file, "r") as f:
-                            score_content = f.read().strip()
-                        score = float(score_content)
-                        logger.info(f"Task {domain}/{example_id} completed with score: {score}")
-                    except (ValueError, IOError) as e:
-                        logger.error(f"Error reading result.txt for {domain}/{example_id}: {e}")
-                        # Corregir archivo corrupto
-                        with open(result_file, "w") as f:
-                            f.write("0.0")
-                        
-            except Exception as e:
-                logger.error(f"Exception in {domain}/{example_id}: {e}")
-                # MEJORA: Verificar si env.controller existe antes de llamar end_recording
-                if hasattr(env, 'controller') and hasattr(env.controller, 'end_recording'):
-                    try:
-                        env.controller.end_recording(
-                            os.path.join(example_result_dir, "recording.mp4")
-                        )
-                    except Exception as recording_error:
-                        logger.warning(f"Could not end recording: {recording_error}")
-                
-                # MEJORA: Crear el archivo de trayectoria con más información del error
-                with open(os.path.join(example_result_dir, "traj.jsonl"), "a") as f:
-                    error_info = {
-                        "Error": f"Exception in {domain}/{example_id}",
-                        "Exception": str(e),
-                        "Type": type(e).__name__,
-                        "Timestamp": datetime.datetime.now().isoformat()
-                    }
-                    f.write(json.dumps(error_info))
-                    f.write("\n")
-                
-                # CRÍTICO: Escribir un archivo de resultado con score 0 para tareas fallidas
-                result_file = os.path.join(example_result_dir, "result.txt")
+                with open(result_file, "r") as f:
+                    score_content = f.read().strip()
+                score = float(score_content)
+                logger.info("Task %s/%s completed with score: %s", domain, example_id, score)
+            except (ValueError, IOError) as e:
+                logger.error("Error reading result.txt for %s/%s: %s", domain, example_id, e)
+                # Corregir archivo corrupto
                 with open(result_file, "w") as f:
                     f.write("0.0")
-                scores.append(0.0)
-                logger.info(f"Task {domain}/{example_id} failed with score: 0.0")
 
-    env.close()
+    except Exception as e:
+        logger.error("Exception in %s/%s: %s", domain, example_id, e)
+        # MEJORA: Verificar si env.controller existe antes de llamar end_recording
+        if hasattr(env, 'controller') and hasattr(env.controller, 'end_recording'):
+            try:
+                env.controller.end_recording(
+                    os.path.join(example_result_dir, "recording.mp4")
+                )
+            except Exception as recording_error:
+                logger.warning("Could not end recording: %s", recording_error)
+
+        # MEJORA: Crear el archivo de trayectoria con más información del error
+        with open(os.path.join(example_result_dir, "traj.jsonl"), "a") as f:
+            error_info = {
+                "Error": f"Exception in {domain}/{example_id}",
+                "Exception": str(e),
+                "Type": type(e).__name__,
+                "Timestamp": datetime.datetime.now().isoformat()
+            }
+            f.write(json.dumps(error_info))
+            f.write("\n")
+
+        # CRÍTICO: Escribir un archivo de resultado con score 0 para tareas fallidas
+        result_file = os.path.join(example_result_dir, "result.txt")
+        with open(result_file, "w") as f:
+            f.write("0.0")
+        scores.append(0.0)
+        logger.info("Task %s/%s failed with score: 0.0", domain, example_id)
+
+
+def flatten_meta(test_config_base_dir: str, test_all_meta: dict) -> list[tuple[str, str, str]]:
+    """
+    Aplana test_all_meta (dominio -> ids de ejemplo) en una lista de (dominio, id de ejemplo, fichero de configuración).
+    """
+    return [
+        (domain, example_id, os.path.join(test_config_base_dir, f"examples/{domain}/{example_id}.json"))
+        for domain, example_ids in test_all_meta.items()
+        for example_id in example_ids
+    ]
+
+def test(args: argparse.Namespace, test_examples: list[tuple[str, str, str]]) -> None:
+    """
+    Ejecuta la evaluación para todas las tareas de test_examples, tal como las devuelve flatten_meta.
+
+    Las tareas se reparten entre args.num_envs hilos, cada uno con su propio agente y entorno.
+    Casi todo el tiempo de un ejemplo se pasa esperando a Gemini, a Omniparser o a la VM, así que
+    los hilos avanzan en paralelo y el tiempo total se divide aproximadamente por num_envs.
+    """
+    scores = []  # list.append es atómico, los hilos comparten la lista
+
+    logger.info("Args: %s", args)
+
+    # Las configuraciones se leen todas a la vez en paralelo antes de empezar, en lugar de
+    # bloquear cada ejemplo con su lectura de disco
+    with ThreadPoolExecutor(thread_name_prefix="config") as executor:
+        examples = list(executor.map(load_example, [config_file for _, _, config_file in test_examples]))
+
+    pending = queue.Queue()
+    for (domain, example_id, _), example in zip(test_examples, examples):
+        pending.put((domain, example_id, example))
+    progress = tqdm(total=pending.qsize(), desc="Example")
+
+    def worker() -> None:
+        agent = BarryAgent(
+            model=args.model, 
+            action_space=args.action_space,
+            observation_type=args.observation_type,
+        )
+
+        env = DesktopEnv(
+            path_to_vm=args.path_to_vm,
+            action_space=agent.action_space,
+            screen_size=(args.screen_width, args.screen_height),
+            headless=args.headless,
+            os_type="Ubuntu",
+            require_a11y_tree=args.observation_type in ["a11y_tree", "screenshot_a11y_tree", "som"],
+        )
+
+        try:
+            while True:
+                try:
+                    domain, example_id, example = pending.get_nowait()
+                except queue.Empty:
+                    return
+                run_example(agent, env, domain, example_id, example, args, scores)
+                progress.update(1)
+        finally:
+            env.close()
+
+    num_envs = max(1, min(args.num_envs, pending.qsize()))
+    with ThreadPoolExecutor(max_workers=num_envs, thread_name_prefix="env") as executor:
+        workers = [executor.submit(worker) for _ in range(num_envs)]
+        for future in workers:
+            future.result()  # propaga los errores al crear un agente o un entorno
+    progress.close()
+
     if scores:
-        logger.info(f"Average score: {sum(scores) / len(scores)}")
+        logger.info("Average score: %s", statistics.fmean(scores))
     else:
         logger.info("No scores recorded")
 
@@ -233,69 +305,71 @@ def get_unfinished(action_space, use_model, observation_type, result_dir, total_
     CRÍTICO: Esta función determina qué tareas ya están completadas.
     """
     target_dir = os.path.join(result_dir, action_space, observation_type, use_model)
-    logger.info(f"Checking for finished tasks in: {target_dir}")
+    logger.info("Checking for finished tasks in: %s", target_dir)
 
     if not os.path.exists(target_dir):
-        logger.info(f"Target directory does not exist: {target_dir} - All tasks will be run")
+        logger.info("Target directory does not exist: %s - All tasks will be run", target_dir)
         return total_file_json
 
     finished = {}
     total_checked = 0
     total_finished = 0
     
-    for domain in os.listdir(target_dir):
-        domain_path = os.path.join(target_dir, domain)
-        if not os.path.isdir(domain_path):
-            continue
-            
-        finished[domain] = []
-        
-        for example_id in os.listdir(domain_path):
-            if example_id == "onboard":
+    # os.scandir devuelve el tipo de cada entrada con el listado, sin una llamada a stat por entrada
+    with os.scandir(target_dir) as domain_entries:
+        for domain_entry in domain_entries:
+            if not domain_entry.is_dir():
                 continue
-                
-            example_path = os.path.join(domain_path, example_id)
-            if not os.path.isdir(example_path):
-                continue
-                
-            total_checked += 1
-            result_file = os.path.join(example_path, "result.txt")
-            
-            if not os.path.exists(result_file):
-                # CRÍTICO: Limpiar tareas incompletas más agresivamente
-                logger.info(f"Cleaning incomplete task: {domain}/{example_id} (no result.txt)")
-                for file in os.listdir(example_path):
-                    file_path = os.path.join(example_path, file)
-                    try:
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
-                    except Exception as e:
-                        logger.warning(f"Could not remove {file_path}: {e}")
-            else:
-                # CRÍTICO: Verificar que result.txt tiene contenido válido
-                try:
-                    with open(result_file, "r") as f:
-                        content = f.read().strip()
-                    
-                    if not content:
-                        logger.warning(f"Empty result.txt for {domain}/{example_id} - marking as incomplete")
-                        os.remove(result_file)
+
+            domain = domain_entry.name
+            finished[domain] = []
+
+            with os.scandir(domain_entry.path) as example_entries:
+                for example_entry in example_entries:
+                    example_id = example_entry.name
+                    if example_id == "onboard" or not example_entry.is_dir():
                         continue
-                    
-                    # Verificar que el contenido es un número válido
-                    score = float(content)
-                    finished[domain].append(example_id)
-                    total_finished += 1
-                    logger.debug(f"Found completed task: {domain}/{example_id} with score {score}")
-                    
-                except (ValueError, IOError) as e:
-                    logger.warning(f"Invalid result.txt for {domain}/{example_id}: {e} - marking as incomplete")
+
+                    total_checked += 1
+                    example_path = example_entry.path
+                    result_file = os.path.join(example_path, "result.txt")
+
+                    # CRÍTICO: Verificar que result.txt tiene contenido válido
+                    # (se abre directamente, sin comprobar antes si existe)
                     try:
-                        os.remove(result_file)
-                    except:
-                        pass
+                        with open(result_file, "r") as f:
+                            content = f.read().strip()
+
+                        if not content:
+                            logger.warning("Empty result.txt for %s/%s - marking as incomplete", domain, example_id)
+                            os.remove(result_file)
+                            continue
+
+                        # Verificar que el contenido es un número válido
+                        score = float(content)
+                        finished[domain].append(example_id)
+                        total_finished += 1
+                        logger.debug("Found completed task: %s/%s with score %s", domain, example_id, score)
+
+                    except FileNotFoundError:
+                        # CRÍTICO: Limpiar tareas incompletas más agresivamente
+                        logger.info("Cleaning incomplete task: %s/%s (no result.txt)", domain, example_id)
+                        with os.scandir(example_path) as file_entries:
+                            for file_entry in file_entries:
+                                try:
+                                    if file_entry.is_file():
+                                        os.remove(file_entry.path)
+                                except Exception as e:
+                                    logger.warning("Could not remove %s: %s", file_entry.path, e)
 
-    logger.info(f"Scan complete: {total_finished}/{total_checked} tasks finished")
+                    except (ValueError, IOError) as e:
+                        logger.warning("Invalid result.txt for %s/%s: %s - marking as incomplete", domain, example_id, e)
+                        try:
+                            os.remove(result_file)
+                        except:
+                            pass
+
+    logger.info("Scan complete: %s/%s tasks finished", total_finished, total_checked)
 
     if not finished:
         logger.info("No finished tasks found")
@@ -305,11 +379,12 @@ def get_unfinished(action_space, use_model, observation_type, result_dir, total_
     for domain, examples in finished.items():
         if domain in total_file_json:
             original_count = len(total_file_json[domain])
+            finished_examples = set(examples)
             total_file_json[domain] = [
-                x for x in total_file_json[domain] if x not in examples
+                x for x in total_file_json[domain] if x not in finished_examples
             ]
             remaining_count = len(total_file_json[domain])
-            logger.info(f"Domain {domain}: {original_count - remaining_count} completed, {remaining_count} remaining")
+            logger.info("Domain %s: %s completed, %s remaining", domain, original_count - remaining_count, remaining_count)
 
     return total_file_json
 
@@ -326,29 +401,32 @@ def get_result(action_space, use_model, observation_type, result_dir, total_file
     completed_tasks = 0
     failed_to_read = 0
 
-    for domain in os.listdir(target_dir):
-        domain_path = os.path.join(target_dir, domain)
-        if os.path.isdir(domain_path):
-            for example_id in os.listdir(domain_path):
-                example_path = os.path.join(domain_path, example_id)
-                if os.path.isdir(example_path):
-                    result_file = os.path.join(example_path, "result.txt")
-                    if os.path.exists(result_file):
-                        try:
-                            with open(result_file, "r") as f:
-                                score = float(f.read().strip())
-                            all_result.append(score)
-                            completed_tasks += 1
-                        except Exception as e:
-                            logger.warning(f"Could not read result for {domain}/{example_id}: {e}")
-                            all_result.append(0.0)
-                            failed_to_read += 1
+    with os.scandir(target_dir) as domain_entries:
+        for domain_entry in domain_entries:
+            if not domain_entry.is_dir():
+                continue
+            with os.scandir(domain_entry.path) as example_entries:
+                for example_entry in example_entries:
+                    if not example_entry.is_dir():
+                        continue
+                    result_file = os.path.join(example_entry.path, "result.txt")
+                    try:
+                        with open(result_file, "r") as f:
+                            score = float(f.read().strip())
+                        all_result.append(score)
+                        completed_tasks += 1
+                    except FileNotFoundError:
+                        continue
+                    except Exception as e:
+                        logger.warning("Could not read result for %s/%s: %s", domain_entry.name, example_entry.name, e)
+                        all_result.append(0.0)
+                        failed_to_read += 1
 
     if not all_result:
         print("New experiment, no result yet.")
         return None
     else:
-        success_rate = sum(all_result) / len(all_result) * 100
+        success_rate = statistics.fmean(all_result) * 100  # media en una sola pasada en C
         print(f"Current Success Rate: {success_rate:.2f}% ({completed_tasks} tasks completed, {failed_to_read} failed to read)")
         return all_result
 
@@ -359,6 +437,11 @@ if __name__ == "__main__":
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
     args = config()
 
+    # Cada hilo necesita su propia VM, una ruta fija solo puede usarla un entorno
+    if args.path_to_vm is not None and args.num_envs > 1:
+        logger.error("--path_to_vm can only be used with --num_envs 1, each environment needs its own VM.")
+        sys.exit(1)
+
     with open(args.test_all_meta_path, "r", encoding="utf-8") as f:
         test_all_meta = json.load(f)
 
@@ -374,13 +457,13 @@ if __name__ == "__main__":
         # Asumir que test_all_meta ya ha sido filtrado a un solo dominio por el bloque anterior
         domain_name = list(test_all_meta.keys())[0] 
         if args.task not in test_all_meta[domain_name]:
-            logger.error(f"Task '{args.task}' not found in domain '{domain_name}'.")
+            logger.error("Task '%s' not found in domain '%s'.", args.task, domain_name)
             sys.exit(1)
         
         # Si se proporciona una tarea específica, establecemos test_file_list para que contenga solo esa tarea
         # y saltamos la llamada a get_unfinished para este filtrado.
         test_file_list = {domain_name: [args.task]}
-        logger.info(f"Explicitly set to execute only task: {args.task} in domain: {domain_name}")
+        logger.info("Explicitly set to execute only task: %s in domain: %s", args.task, domain_name)
     else:
         # Si no se especifica una tarea, usamos get_unfinished para determinar las tareas restantes
         # en el flujo de evaluación general.
@@ -399,7 +482,7 @@ if __name__ == "__main__":
         left_info += f"{domain}: {count}\n"
         total_remaining += count
     
-    logger.info(f"Left tasks ({total_remaining} total):\n{left_info}")
+    logger.info("Left tasks (%s total):\n%s", total_remaining, left_info)
 
     # CAMBIO: Usar args.model consistentemente
     get_result(
@@ -411,6 +494,6 @@ if __name__ == "__main__":
     )
     
     if total_remaining > 0:
-        test(args, test_file_list)
+        test(args, flatten_meta(args.test_config_base_dir, test_file_list))
     else:
         logger.info("No tasks remaining to execute")
\ No newline at end of file
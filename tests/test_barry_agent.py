@@ -0,0 +1,26 @@
+import unittest
+
+from Barry_Agent.barry_agent import _ACTION_LINE_RE
+
+
+class ActionLinesTest(unittest.TestCase):
+    def test_multi_line_indented_action_keeps_its_indentation(self):
+        action = (
+            "```python\r\n"
+            "for _ in range(3):\r\n"
+            "    pyautogui.press('down')  \r\n"
+            "\r\n"
+            "    pyautogui.press('enter')\t\n"
+            "pyautogui.hotkey('ctrl', 's')\n"
+            "```\n"
+        )
+        self.assertEqual(_ACTION_LINE_RE.findall(action), [
+            "for _ in range(3):",
+            "    pyautogui.press('down')",
+            "    pyautogui.press('enter')",
+            "pyautogui.hotkey('ctrl', 's')",
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import json
+import unittest
+
+from Barry_Agent.plan_cache import task_skeleton, parameterize, fill_slots
+
+
+def _json_entities(task):
+    """
+    Extracts the task specific values as they appear inside a JSON response, like `decompose_main_task`.
+    """
+    skeleton, entities = task_skeleton(task)
+    return skeleton, [json.dumps(entity)[1:-1] for entity in entities]
+
+
+class PlanTemplateTest(unittest.TestCase):
+    def test_replayed_template_contains_no_old_values(self):
+        skeleton, entities = _json_entities('Rename "report.txt" to "report.txt.bak" and open https://example.com/report')
+        response = json.dumps({"subtask": 'Rename "report.txt" to "report.txt.bak" in https://example.com/report'})
+
+        template = parameterize(response, entities)
+        self.assertIsNotNone(template)
+
+        new_skeleton, new_entities = _json_entities('Rename "notes.md" to "old_notes.md" and open https://example.org/notes')
+        self.assertEqual(skeleton, new_skeleton)
+
+        replayed = fill_slots(template, new_entities)
+        for entity in entities:
+            self.assertNotIn(entity, replayed)
+        self.assertEqual(
+            json.loads(replayed)["subtask"],
+            'Rename "notes.md" to "old_notes.md" in https://example.org/notes',
+        )
+
+    def test_no_template_when_a_value_is_not_replaced(self):
+        _, entities = _json_entities('Download "dog.png" into "images"')
+        response = json.dumps({"subtask": "Open the browser"})
+        self.assertIsNone(parameterize(response, entities))
+
+    def test_no_template_when_a_value_is_too_short(self):
+        _, entities = _json_entities('Type "ok" in the dialog')
+        response = json.dumps({"subtask": 'Type "ok" in the dialog'})
+        self.assertIsNone(parameterize(response, entities))
+
+    def test_abbreviations_and_numbers_are_not_entities(self):
+        _, entities = task_skeleton("Set the zoom to 3.5, e.g using the menu, and save notes.txt")
+        self.assertEqual(entities, ["notes.txt"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from Barry_Agent import reflection_expert
+from Barry_Agent.reflection_expert import ReflectionExpert
+
+
+class FakeModel:
+    """
+    Stands in for the Gemini model. Execution verdicts always fail, and an error evaluation applies the
+    "2 chances" rule of the system instruction to the minor errors it finds in its context.
+    """
+
+    def generate_content(self, contents, generation_config=None):
+        if generation_config is reflection_expert.EVALUATE_EXECUTION_GENERATION_CONFIG:
+            text = json.dumps({"ok": False})
+        elif generation_config is reflection_expert.EVALUATE_ERROR_GENERATION_CONFIG:
+            previous_minor_errors = sum(
+                1 for message in contents
+                if message["role"] == "model" and '"severity": "minor"' in message["parts"][0]
+            )
+            severity = "major" if previous_minor_errors >= 2 else "minor"
+            text = json.dumps({"fix": "Click the Save button", "severity": severity})
+        else:
+            text = "Click the Save button"
+        return mock.Mock(text=text)
+
+
+class ErrorEscalationTest(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.object(reflection_expert, "configure_gemini"), \
+                mock.patch.object(reflection_expert, "get_model", return_value=FakeModel()):
+            self.expert = ReflectionExpert(use_verdict_cache=False)
+
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        self.expert.log_file = os.path.join(log_dir.name, "chat_history.log")
+
+        self.expert.set_subtask_and_instructions(["Save the document"])
+
+    def test_third_repeated_minor_error_is_escalated(self):
+        severities = []
+        for shade in range(3):
+            successful, (severity, _) = self.expert.evaluate_execution_and_error(Image.new("RGB", (64, 64), (shade, 0, 0)))
+            self.assertFalse(successful)
+            severities.append(severity)
+            if severity == "minor":
+                self.expert.create_new_instruction()
+
+        self.assertEqual(severities, ["minor", "minor", "major"])
+
+    def test_errors_of_a_previous_subtask_are_not_counted(self):
+        for shade in range(2):
+            self.expert.evaluate_execution_and_error(Image.new("RGB", (64, 64), (shade, 0, 0)))
+            self.expert.create_new_instruction()
+
+        self.expert.set_subtask_and_instructions(["Close the document"])
+        _, (severity, _) = self.expert.evaluate_execution_and_error(Image.new("RGB", (64, 64), (2, 0, 0)))
+        self.assertEqual(severity, "minor")
+
+
+if __name__ == "__main__":
+    unittest.main()